@@ -0,0 +1,149 @@
+# asyncio front end of NFCReader; PN532 exchanges run on a thread owned by the reader
+from abc import ABC, abstractmethod
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import time
+
+from nfc_reader import NFCReader, iter_image_blocks
+
+
+logger = logging.getLogger(__name__)
+
+# Longest single poll while waiting for a card; a cancelled wait returns within it
+DEFAULT_POLL_TIMEOUT = 0.05
+
+
+class AsyncNFCReaderInterface(ABC):
+
+    @abstractmethod
+    async def detect(self, timeout=1):
+        pass
+
+    @abstractmethod
+    async def authenticate(self, uid, block_number):
+        pass
+
+    @abstractmethod
+    async def read_block(self, uid, block_number):
+        pass
+
+    @abstractmethod
+    async def read_all_blocks(self, uid, include_trailers=False):
+        pass
+
+    @abstractmethod
+    async def write_block(self, uid, block_number, data):
+        pass
+
+
+class AsyncNFCReader(AsyncNFCReaderInterface):
+    """
+    Awaitable NFCReader.
+
+    Every call is run on a single-thread executor that belongs to this reader, so
+    PN532 exchanges never overlap and never block the event loop. Waiting for a
+    card or for its removal is split into polls of poll_timeout seconds; when the
+    awaiting task is cancelled no further poll is started, and the one in flight
+    finishes on the reader's thread before the next call is run.
+    """
+
+    def __init__(self, reader, poll_timeout=DEFAULT_POLL_TIMEOUT):
+        self.reader = reader
+        self.poll_timeout = poll_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nfc-reader")
+
+    @classmethod
+    async def open(cls, poll_timeout=DEFAULT_POLL_TIMEOUT, **reader_kwargs):
+        """
+        Build and configure an NFCReader(**reader_kwargs) on the reader's thread.
+        """
+        async_reader = cls(None, poll_timeout)
+        try:
+            async_reader.reader = await async_reader._call(NFCReader, **reader_kwargs)
+        except BaseException:
+            async_reader._executor.shutdown(wait=False)
+            raise
+        return async_reader
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+    async def close(self):
+        """
+        Wait for the exchange in flight, then stop the reader's thread.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+
+    async def detect(self, timeout=1):
+        """
+        UID of the card in the field as bytes, or None after timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            poll = min(self.poll_timeout, max(deadline - time.monotonic(), 0))
+            uid = await self._call(self.reader.read_passive_target, timeout=poll)
+            if uid is not None:
+                return bytes(uid)
+            if time.monotonic() >= deadline:
+                return None
+
+    async def wait_for_removal(self, uid, debounce=0.2, timeout=None):
+        """
+        Like NFCReader.wait_for_removal, but cancellable between two polls.
+        """
+        uid = bytes(uid)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        absent_since = None
+        while True:
+            current = await self.detect(timeout=self.poll_timeout)
+            now = time.monotonic()
+            if current is not None and current != uid:
+                return True
+            if current is not None:
+                absent_since = None
+            elif absent_since is None:
+                absent_since = now
+            if absent_since is not None and now - absent_since >= debounce:
+                return True
+            if deadline is not None and now >= deadline:
+                return False
+
+    async def authenticate(self, uid, block_number):
+        return await self._call(self.reader._authenticate, uid, block_number)
+
+    async def read_block(self, uid, block_number):
+        return await self._call(self.reader.read_block, uid, block_number)
+
+    async def read_all_blocks(self, uid, include_trailers=False):
+        return await self._call(self.reader.read_all_blocks, uid, include_trailers)
+
+    async def write_block(self, uid, block_number, data):
+        return await self._call(self.reader.write_block, uid, block_number, data)
+
+    async def is_alive(self):
+        return await self._call(self.reader.is_alive)
+
+
+async def _dump_card():
+    async with await AsyncNFCReader.open() as reader:
+        logger.info("Waiting for RFID/NFC card...")
+        uid = None
+        while uid is None:
+            uid = await reader.detect(timeout=0.5)
+        logger.info("Found card with UID: %s", [hex(i) for i in uid])
+        image = await reader.read_all_blocks(uid)
+    for block_number, block_data in iter_image_blocks(image):
+        logger.info("Data in Block %d: %s", block_number, " ".join(f"{byte:02x}" for byte in block_data))
+
+
+if __name__ == "__main__":
+    asyncio.run(_dump_card())
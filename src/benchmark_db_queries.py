@@ -0,0 +1,111 @@
+# Latency of the stations' hot queries against table size, with and without the tuning profile
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+from benchmark_stats import percentile
+import station_db
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(SRC_DIR, "..", "data", "flaschen_database.db")
+
+QUERIES = {
+    # Station 1: next free bottle ID
+    "untagged_bottle": ('''
+        SELECT Flaschen_ID
+        FROM Flasche f
+        WHERE Tagged_Date = 0
+          AND NOT EXISTS (SELECT 1 FROM Flaschen_Reservierung r WHERE r.Flaschen_ID = f.Flaschen_ID)
+        LIMIT 1
+    ''', lambda rows: ()),
+    # Station 2: recipe of one bottle
+    "recipe_for_bottle": ('''
+        SELECT Granulat_ID, Menge
+        FROM Rezept_besteht_aus_Granulat
+        WHERE Rezept_ID = (SELECT Rezept_ID FROM Flasche WHERE Flaschen_ID = ?)
+    ''', lambda rows: (rows // 2,)),
+}
+
+
+def build_database(source, path, rows, untagged_fraction):
+    """
+    Copy the schema and recipes of source and fill Flasche with `rows` bottles,
+    the last untagged_fraction of them untagged, as on a line that has been running.
+    """
+    src = sqlite3.connect(source)
+    conn = sqlite3.connect(path)
+    try:
+        for (sql,) in src.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND sql IS NOT NULL"):
+            conn.execute(sql)
+        recipes = src.execute("SELECT Rezept_ID, Granulat_ID, Menge FROM Rezept_besteht_aus_Granulat").fetchall()
+        conn.executemany("INSERT INTO Rezept_besteht_aus_Granulat VALUES (?, ?, ?)", recipes)
+        recipe_ids = sorted({row[0] for row in recipes})
+        first_untagged = int(rows * (1 - untagged_fraction))
+        conn.executemany(
+            "INSERT INTO Flasche (Flaschen_ID, Rezept_ID, Tagged_Date, has_error) VALUES (?, ?, ?, 0)",
+            ((i, recipe_ids[i % len(recipe_ids)], 0 if i >= first_untagged else 1733825029 + i)
+             for i in range(1, rows + 1)),
+        )
+        conn.commit()
+        # The reservation table is part of the migrations; create it for the untuned run as well
+        conn.execute(station_db.MIGRATIONS[0])
+        conn.commit()
+    finally:
+        src.close()
+        conn.close()
+
+
+def time_query(conn, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append(time.perf_counter() - started)
+    return {
+        "p50_ms": round(percentile(samples, 50) * 1000, 4),
+        "p95_ms": round(percentile(samples, 95) * 1000, 4),
+        "max_ms": round(max(samples) * 1000, 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure station query latency against table size.")
+    parser.add_argument("--sizes", default="1000,10000,100000,500000", help="comma separated Flasche row counts")
+    parser.add_argument("--untagged-fraction", type=float, default=0.01)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="database to take schema and recipes from")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="db-bench-") as scratch:
+        for rows in (int(size) for size in args.sizes.split(",")):
+            path = os.path.join(scratch, f"flaschen_{rows}.db")
+            build_database(args.db, path, rows, args.untagged_fraction)
+            entry = {"rows": rows}
+
+            conn = sqlite3.connect(path)
+            entry["default"] = {name: time_query(conn, sql, params(rows), args.repeat)
+                                for name, (sql, params) in QUERIES.items()}
+            conn.close()
+
+            conn = station_db.connect(path)
+            entry["tuned"] = {name: time_query(conn, sql, params(rows), args.repeat)
+                              for name, (sql, params) in QUERIES.items()}
+            conn.close()
+            results.append(entry)
+
+    report = json.dumps({"timestamp": int(time.time()), "config": vars(args), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# Throughput benchmark for the station state machines against a simulated PN532
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from benchmark_stats import percentile
+from nfc_reader import NFCReader
+from pn532_sim import SimulatedCard, SimulatedPN532
+from recipe_cache import RecipeCache
+import station_db
+from station_files import SRC_DIR, load_station
+import station_logging
+import tag_record
+
+
+DEFAULT_DB_PATH = os.path.join(SRC_DIR, "..", "data", "flaschen_database.db")
+BLOCK_NUMBER = 2
+
+
+def prepare_db(db_path, bottles):
+    """
+    Reset all bottles to untagged and make sure there are at least `bottles` rows.
+    """
+    conn = station_db.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE Flasche SET Tagged_Date = 0, has_error = 0, Tag_UID = NULL")
+        count, max_id = cursor.execute("SELECT COUNT(*), COALESCE(MAX(Flaschen_ID), 0) FROM Flasche").fetchone()
+        recipe_ids = [row[0] for row in cursor.execute(
+            "SELECT DISTINCT Rezept_ID FROM Rezept_besteht_aus_Granulat ORDER BY Rezept_ID"
+        )]
+        cursor.executemany(
+            "INSERT INTO Flasche (Flaschen_ID, Rezept_ID, Tagged_Date, has_error) VALUES (?, ?, 0, 0)",
+            ((max_id + i + 1, recipe_ids[i % len(recipe_ids)]) for i in range(max(0, bottles - count))),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def pretag_cards(db_path, cards):
+    """
+    Write tag records onto the cards the way Station 1 does, for running Station 2 on its own.
+    """
+    conn = station_db.connect(db_path)
+    try:
+        recipes = RecipeCache(conn)
+        bottles = conn.execute(
+            "SELECT Flaschen_ID, Rezept_ID FROM Flasche ORDER BY Flaschen_ID LIMIT ?", (len(cards),)
+        ).fetchall()
+        now = int(time.time())
+        for card, (bottle_id, recipe_id) in zip(cards, bottles):
+            record = tag_record.TagRecord(bottle_id, recipe_id, now, recipe_digest=recipes.digest(recipe_id))
+            card.blocks[BLOCK_NUMBER][:] = tag_record.encode(record)
+            conn.execute("UPDATE Flasche SET Tagged_Date = ?, Tag_UID = ? WHERE Flaschen_ID = ?", (now, card.uid, bottle_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class ConveyorReader(NFCReader):
+    """
+    NFCReader whose bottle is carried out of the field as soon as the station waits
+    for its removal, unless the simulator already moves bottles on a fixed dwell time.
+    """
+
+    def wait_for_removal(self, uid, **kwargs):
+        if self._pn532.dwell is None:
+            self._pn532.remove_card()
+        return super().wait_for_removal(uid, **kwargs)
+
+
+class StationRecorder:
+    """
+    StateMachine listener collecting per-state latencies and counting finished bottles.
+    """
+
+    def __init__(self, machine, pn532, bottles, station):
+        self.machine = machine
+        self.pn532 = pn532
+        self.bottles = bottles
+        self.station = station
+        self.latencies = defaultdict(list)
+        self.completed = 0
+        self.started = None
+        self.finished = None
+        self.write_behind_metrics = None
+        self.qr_metrics = None
+
+    def __call__(self, state, next_state, elapsed):
+        self.latencies[state].append(elapsed)
+        if state == 'State0':
+            self.started = time.perf_counter()
+            return
+
+        if state == 'State4':
+            self.completed += 1
+        if self.completed >= self.bottles:
+            self.finished = time.perf_counter()
+            self.machine.stop()
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        commands = dict(self.pn532.command_counts)
+        per_bottle = max(self.completed, 1)
+        # Counted on all of the station's connections, background workers included
+        db_queries = dict(self.machine.metrics.sql_queries)
+        return {
+            "station": self.station,
+            "bottles": self.completed,
+            "elapsed_s": round(elapsed, 4),
+            "bottles_per_minute": round(self.completed / elapsed * 60, 3) if elapsed > 0 else None,
+            "states": {
+                state: {
+                    "count": len(values),
+                    "mean_ms": round(sum(values) / len(values) * 1000, 3),
+                    "p50_ms": round(percentile(values, 50) * 1000, 3),
+                    "p95_ms": round(percentile(values, 95) * 1000, 3),
+                    "p99_ms": round(percentile(values, 99) * 1000, 3),
+                }
+                for state, values in sorted(self.latencies.items())
+            },
+            "spi_commands": {
+                "total": sum(commands.values()),
+                "per_bottle": round(sum(commands.values()) / per_bottle, 2),
+                "by_command": commands,
+            },
+            "db_queries": {
+                "total": sum(db_queries.values()),
+                "per_bottle": round(sum(db_queries.values()) / per_bottle, 2),
+                "by_statement": db_queries,
+            },
+            "write_behind": self.write_behind_metrics,
+            "qr_renderer": self.qr_metrics,
+        }
+
+
+def run_station(station, db_path, cards, args):
+    module = load_station(station)
+    if not args.verbose:
+        # Station logs still go to their files in the scratch directory
+        station_logging.set_console_level(logging.WARNING)
+
+    pn532 = SimulatedPN532(
+        cards=cards,
+        latency=args.latency,
+        auth_failure_rate=args.auth_failure_rate,
+        removal_rate=args.removal_rate,
+        dwell=args.dwell,
+        gap=args.gap,
+        seed=args.seed,
+    )
+    machine = module.StateMachine(db_path, nfc_reader=ConveyorReader(pn532=pn532))
+    recorder = StationRecorder(machine, pn532, len(cards), station)
+    machine.listeners.append(recorder)
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        machine.run()
+    # Station 1 commits its results on its own connection; report them after the final flush
+    if getattr(machine, "tagging_writer", None) is not None:
+        recorder.write_behind_metrics = {name: value for name, _, value, _ in machine.tagging_writer.metrics()}
+    # Station 2 waits for outstanding QR codes before run() returns
+    if getattr(machine, "qr_renderer", None) is not None:
+        recorder.qr_metrics = {name: value for name, _, value, _ in machine.qr_renderer.metrics()}
+    return recorder.report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the station state machines through simulated bottles.")
+    parser.add_argument("--station", choices=["1", "2", "both"], default="both")
+    parser.add_argument("--bottles", type=int, default=10, help="number of bottles per station")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="database to copy into the scratch directory")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--latency", type=float, default=None,
+                        help="fixed latency per PN532 command in seconds (default: per-command estimates)")
+    parser.add_argument("--auth-failure-rate", type=float, default=0.0)
+    parser.add_argument("--removal-rate", type=float, default=0.0)
+    parser.add_argument("--dwell", type=float, default=None,
+                        help="seconds a bottle stays in the field; by default it leaves once the station is done")
+    parser.add_argument("--gap", type=float, default=0.0, help="seconds between two bottles")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="keep station logging and output on the console")
+    args = parser.parse_args(argv)
+
+    # nfc_reader has already configured the root logger on import
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    stations = [1, 2] if args.station == "both" else [int(args.station)]
+    rng = random.Random(args.seed)
+    cards = [SimulatedCard.random(rng) for _ in range(args.bottles)]
+
+    scratch = tempfile.mkdtemp(prefix="station-bench-")
+    cwd = os.getcwd()
+    os.environ["STATION_LOG_DIR"] = os.path.join(scratch, "logging")
+    try:
+        db_path = os.path.join(scratch, "flaschen_database.db")
+        shutil.copyfile(args.db, db_path)
+        prepare_db(db_path, args.bottles)
+        if stations == [2]:
+            pretag_cards(db_path, cards)
+
+        # Station 2 writes its QR codes relative to the working directory
+        os.chdir(scratch)
+        results = {
+            "timestamp": int(time.time()),
+            "config": vars(args),
+            "stations": [run_station(station, db_path, cards, args) for station in stations],
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    else:
+        print(report)
+    return results
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
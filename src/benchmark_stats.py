@@ -0,0 +1,14 @@
+# Statistics shared by the benchmark scripts, so their reports can be compared
+import math
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile: the smallest value that at least percent % of the values do not exceed.
+    None for no values.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = math.ceil(percent / 100 * len(ordered))
+    return ordered[min(len(ordered), max(rank, 1)) - 1]
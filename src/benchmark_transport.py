@@ -0,0 +1,134 @@
+# Round-trip latency of PN532 commands per transport and SPI clock
+import argparse
+import json
+import logging
+import sys
+import time
+
+from benchmark_stats import percentile
+from nfc_reader import (BACKENDS, DEFAULT_KEY_A, NFCReader, is_sector_trailer, logger as nfc_logger,
+                        set_spi_baudrate)
+
+
+DEFAULT_SPI_BAUDRATES = "100000,400000,1000000,2000000,4000000,5000000"
+# A data block nothing else uses; the station's bottle record lives in block 2
+DEFAULT_BLOCK = 4
+OPERATIONS = ("detect", "authenticate", "read", "write")
+
+
+def summarize(samples, failures):
+    if not samples:
+        return {"p50_ms": None, "p95_ms": None, "max_ms": None, "failures": failures}
+    return {
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+        "failures": failures,
+    }
+
+
+def timed(call, *args):
+    started = time.perf_counter()
+    try:
+        result = call(*args)
+    except Exception:
+        result = None
+    return result, time.perf_counter() - started
+
+
+def measure(pn532, block, iterations):
+    """
+    Detect, authenticate, read and write back the card's own data `iterations` times.
+    A None/False result, an exception or data that does not read back counts as a failure.
+    """
+    samples = {operation: [] for operation in OPERATIONS}
+    failures = dict.fromkeys(OPERATIONS, 0)
+    original = None
+    for _ in range(iterations):
+        uid, elapsed = timed(pn532.read_passive_target, 0x00, 0.5)
+        if uid is None:
+            failures["detect"] += 1
+            continue
+        samples["detect"].append(elapsed)
+
+        authenticated, elapsed = timed(pn532.mifare_classic_authenticate_block, uid, block, 0x60, DEFAULT_KEY_A)
+        if not authenticated:
+            failures["authenticate"] += 1
+            continue
+        samples["authenticate"].append(elapsed)
+
+        data, elapsed = timed(pn532.mifare_classic_read_block, block)
+        if data is None or (original is not None and bytes(data) != original):
+            failures["read"] += 1
+            continue
+        samples["read"].append(elapsed)
+        original = bytes(data)
+
+        # Writes the block's own content back, so the card is left unchanged
+        written, elapsed = timed(pn532.mifare_classic_write_block, block, original)
+        if not written:
+            failures["write"] += 1
+            continue
+        samples["write"].append(elapsed)
+    return {operation: summarize(samples[operation], failures[operation]) for operation in OPERATIONS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure PN532 read/auth/write round trips per transport setting. Hold a MIFARE Classic card on the reader."
+    )
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="spi")
+    parser.add_argument("--baudrates", default=DEFAULT_SPI_BAUDRATES, help="comma separated SPI clocks to compare")
+    parser.add_argument("--cs-pin", help="SPI chip select pin name on board, e.g. D8")
+    parser.add_argument("--port", help="serial port for the uart backend")
+    parser.add_argument("--block", type=int, default=DEFAULT_BLOCK, help="data block to read and write back")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.block == 0 or is_sector_trailer(args.block):
+        parser.error("block 0 and sector trailers must not be written")
+    nfc_logger.setLevel(logging.WARNING)
+
+    options = {}
+    if args.cs_pin:
+        options["cs_pin"] = args.cs_pin
+    if args.port:
+        options["port"] = args.port
+    reader = NFCReader(backend=args.backend, options=options)
+    pn532 = reader._pn532
+    if args.backend == "sim":
+        # Keep one card in the field for the whole run
+        from pn532_sim import SimulatedCard
+        pn532.dwell = None
+        pn532.add_card(SimulatedCard.random())
+
+    results = []
+    settings = [int(baudrate) for baudrate in args.baudrates.split(",")] if args.backend == "spi" else [None]
+    for baudrate in settings:
+        if baudrate is not None:
+            set_spi_baudrate(pn532, baudrate)
+        entry = {"backend": args.backend, "baudrate": baudrate, "operations": measure(pn532, args.block, args.iterations)}
+        entry["failures"] = sum(operation["failures"] for operation in entry["operations"].values())
+        results.append(entry)
+        print(f"{args.backend} {baudrate or '':>8}: failures {entry['failures']}, "
+              + ", ".join(f"{name} p50 {stats['p50_ms']} ms" for name, stats in entry["operations"].items()),
+              file=sys.stderr)
+
+    reliable = [entry for entry in results if entry["failures"] == 0]
+    fastest = max(reliable, key=lambda entry: entry["baudrate"] or 0) if reliable else None
+    report = json.dumps({
+        "timestamp": int(time.time()),
+        "config": vars(args),
+        "results": results,
+        "fastest_reliable": fastest and {"backend": fastest["backend"], "baudrate": fastest["baudrate"]},
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
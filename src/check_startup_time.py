@@ -0,0 +1,59 @@
+# Import-time budget of the station scripts
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from station_files import SRC_DIR, STATION_FILES
+
+
+DEFAULT_BUDGET_MS = 250
+# Loaded on first use only; importing a station must not pull them in
+LAZY_MODULES = ("board", "busio", "digitalio", "adafruit_pn532", "qrcode", "PIL",
+                "http.server", "cProfile", "concurrent.futures.process")
+
+# Runs in a fresh interpreter, so every measurement is a cold import
+MEASURE = '''
+import time
+started = time.perf_counter()
+import importlib.util, json, sys
+spec = importlib.util.spec_from_file_location("station", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+elapsed = time.perf_counter() - started
+print(json.dumps({"ms": elapsed * 1000, "loaded": [name for name in sys.argv[2:] if name in sys.modules]}))
+'''
+
+
+def measure(path, log_dir):
+    env = dict(os.environ, STATION_LOG_DIR=log_dir)
+    output = subprocess.run([sys.executable, "-c", MEASURE, path, *LAZY_MODULES], env=env, cwd=SRC_DIR,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the stations import within the startup budget.")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--repeat", type=int, default=5, help="imports per station, the median is compared")
+    args = parser.parse_args(argv)
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix="startup-") as log_dir:
+        for station, path in STATION_FILES.items():
+            runs = [measure(path, log_dir) for _ in range(args.repeat)]
+            median = statistics.median(run["ms"] for run in runs)
+            loaded = sorted({name for run in runs for name in run["loaded"]})
+            verdict = "ok" if median <= args.budget_ms and not loaded else "FAIL"
+            failed |= verdict == "FAIL"
+            print(f"Station {station}: {median:.1f} ms median import (budget {args.budget_ms:.0f} ms) {verdict}")
+            if loaded:
+                print(f"  imported eagerly: {', '.join(loaded)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
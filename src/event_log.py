@@ -0,0 +1,220 @@
+# Structured production event log of the stations and its query tool
+import argparse
+from datetime import datetime
+import glob
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import station_logging
+
+
+EVENT_FILE_PATTERN = "station*_events.jsonl"
+INDEX_FILE_NAME = "events_index.db"
+# States that belong to one bottle; events of the others carry no bottle fields
+BOTTLE_STATES = ("State2", "State3", "State4")
+
+
+def event_logger(station):
+    """
+    Return the logger for the JSON Lines event file of a station, e.g. station1_events.jsonl.
+    """
+    return station_logging.event_logger(f"Station{station}Events", f"station{station}_events.jsonl")
+
+
+class EventRecorder:
+    """
+    StateMachine listener that writes one JSON line per state run.
+
+    Every event has the time, station, state, next state and duration; events of
+    bottle states add the fields returned by machine.event_fields(state), and a
+    state that failed adds the type and message of machine.last_error.
+    record_failure() adds an event for work that failed later, off the state
+    machine's thread. Lines go through the station_logging queue, so the state
+    machine does not wait for the disk.
+    """
+
+    def __init__(self, machine, station, logger=None):
+        self.machine = machine
+        self.station = station
+        self.logger = logger or event_logger(station)
+
+    def __call__(self, state, next_state, elapsed):
+        event = {
+            "ts": round(time.time(), 3),
+            "station": self.station,
+            "state": state,
+            "next": next_state,
+            "ms": round(elapsed * 1000, 3),
+        }
+        if self.machine.lane is not None:
+            event["lane"] = self.machine.lane
+        if state in BOTTLE_STATES:
+            event.update(self.machine.event_fields(state))
+        self._write(event, self.machine.last_error)
+
+    def record_failure(self, state, error, **fields):
+        """
+        Write an event for work of `state` that failed after the state itself had
+        run, e.g. a job on the station's worker stage.
+        """
+        event = {"ts": round(time.time(), 3), "station": self.station, "state": state, "deferred": True}
+        if self.machine.lane is not None:
+            event["lane"] = self.machine.lane
+        event.update(fields)
+        self._write(event, error)
+
+    def _write(self, event, error):
+        if error is not None:
+            event["error"] = type(error).__name__
+            event["message"] = str(error)
+        self.logger.info(json.dumps(event, separators=(",", ":")))
+
+
+class EventIndex:
+    """
+    SQLite index over the event files: byte offset of every event by bottle, time and error.
+
+    The index remembers how far each file has been read, so updating it only parses
+    events appended since the last query.
+    """
+
+    def __init__(self, index_path):
+        self.conn = sqlite3.connect(index_path)
+        # The index can always be rebuilt from the event files
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS Indexed_File (
+                File_ID INTEGER PRIMARY KEY,
+                Path TEXT NOT NULL UNIQUE,
+                Size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS Event (
+                File_ID INTEGER NOT NULL REFERENCES Indexed_File (File_ID),
+                Offset INTEGER NOT NULL,
+                Ts REAL NOT NULL,
+                Station INTEGER,
+                Bottle_ID INTEGER,
+                Error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_event_bottle ON Event (Bottle_ID, Ts);
+            CREATE INDEX IF NOT EXISTS idx_event_ts ON Event (Ts);
+            CREATE INDEX IF NOT EXISTS idx_event_error ON Event (Error, Ts);
+        ''')
+
+    def update(self, paths):
+        """
+        Index what was appended to paths since the last update. Returns the number of new events.
+        """
+        added = 0
+        for path in paths:
+            row = self.conn.execute("SELECT File_ID, Size FROM Indexed_File WHERE Path = ?", (path,)).fetchone()
+            if row is None:
+                with self.conn:
+                    file_id = self.conn.execute("INSERT INTO Indexed_File (Path, Size) VALUES (?, 0)", (path,)).lastrowid
+                start = 0
+            else:
+                file_id, start = row
+            size = os.path.getsize(path)
+            if size < start:
+                # Truncated or replaced, index it again from the start
+                with self.conn:
+                    self.conn.execute("DELETE FROM Event WHERE File_ID = ?", (file_id,))
+                start = 0
+            if size == start:
+                continue
+
+            rows = []
+            with open(path, "rb") as event_file:
+                event_file.seek(start)
+                offset = start
+                for line in event_file:
+                    if not line.endswith(b"\n"):
+                        # Still being written; picked up by the next update
+                        break
+                    try:
+                        event = json.loads(line)
+                        rows.append((file_id, offset, event["ts"], event.get("station"),
+                                     event.get("bottle_id"), event.get("error")))
+                    except (ValueError, KeyError):
+                        pass
+                    offset += len(line)
+            with self.conn:
+                self.conn.executemany("INSERT INTO Event VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.conn.execute("UPDATE Indexed_File SET Size = ? WHERE File_ID = ?", (offset, file_id))
+            added += len(rows)
+        return added
+
+    def find(self, bottle_id=None, since=None, until=None, error=None, station=None, limit=None):
+        """
+        (path, offset) of the matching events in time order.
+        """
+        conditions, params = [], []
+        for column, operator, value in (("Bottle_ID", "=", bottle_id), ("Ts", ">=", since), ("Ts", "<", until),
+                                        ("Error", "=", error), ("Station", "=", station)):
+            if value is not None:
+                conditions.append(f"{column} {operator} ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"SELECT Path, Offset FROM Event JOIN Indexed_File USING (File_ID) {where} ORDER BY Ts, File_ID, Offset"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.conn.execute(query, params).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+def read_events(locations):
+    """
+    Yield the events stored at (path, offset) locations.
+    """
+    files = {}
+    try:
+        for path, offset in locations:
+            if path not in files:
+                files[path] = open(path, "rb")
+            files[path].seek(offset)
+            yield json.loads(files[path].readline())
+    finally:
+        for event_file in files.values():
+            event_file.close()
+
+
+def parse_time(value):
+    """
+    Unix timestamp or ISO 8601 date/time.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the stations' production event log.")
+    parser.add_argument("--log-dir", default=None, help="directory with the event files (default: STATION_LOG_DIR)")
+    parser.add_argument("--bottle", type=int, help="events of one Flaschen_ID")
+    parser.add_argument("--since", type=parse_time, help="from this time (Unix timestamp or ISO 8601)")
+    parser.add_argument("--until", type=parse_time, help="before this time")
+    parser.add_argument("--error", help="events that failed with this error type, e.g. IdleTimeout")
+    parser.add_argument("--station", type=int, choices=[1, 2])
+    parser.add_argument("--limit", type=int)
+    args = parser.parse_args(argv)
+
+    log_dir = args.log_dir or os.environ.get(station_logging.LOG_DIR_ENV_VAR, station_logging.DEFAULT_LOG_DIRECTORY)
+    index = EventIndex(os.path.join(log_dir, INDEX_FILE_NAME))
+    try:
+        index.update(sorted(glob.glob(os.path.join(log_dir, EVENT_FILE_PATTERN))))
+        locations = index.find(args.bottle, args.since, args.until, args.error, args.station, args.limit)
+        for event in read_events(locations):
+            sys.stdout.write(json.dumps(event, separators=(",", ":")) + "\n")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+# Batch export of bottle QR labels into one ZIP, TAR or PDF file
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import io
+import logging
+import os
+import re
+import sqlite3
+import tarfile
+import time
+import zipfile
+
+from PIL import Image
+
+from qr_renderer import DEFAULT_BOX_SIZE, QR_FORMATS, encode_qr, label_content, label_file_name
+
+
+logger = logging.getLogger(__name__)
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(SRC_DIR, "..", "data", "flaschen_database.db")
+# Rows read from the database and rendered per round
+DEFAULT_BATCH_SIZE = 256
+LABEL_NAME_PATTERN = re.compile(r"qr_bottle_(\d+)\.\w+$")
+
+
+def bottle_ids_in(names):
+    return {int(match.group(1)) for match in map(LABEL_NAME_PATTERN.search, names) if match}
+
+
+class ZipSink:
+    """
+    Labels as members of a ZIP archive. The archive is closed after every batch,
+    so an interrupted export leaves a readable archive to resume from.
+    """
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        # PNG is already compressed
+        self.compression = zipfile.ZIP_STORED if fmt == "png" else zipfile.ZIP_DEFLATED
+        self._archive = None
+
+    def existing(self):
+        if not os.path.exists(self.path):
+            return set()
+        with zipfile.ZipFile(self.path) as archive:
+            return bottle_ids_in(archive.namelist())
+
+    def add(self, bottle_id, data):
+        if self._archive is None:
+            self._archive = zipfile.ZipFile(self.path, "a" if os.path.exists(self.path) else "w", self.compression)
+        self._archive.writestr(label_file_name(bottle_id, self.fmt), data)
+
+    def commit(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def close(self):
+        self.commit()
+
+
+class TarSink:
+    """
+    Labels as members of an uncompressed TAR archive, appended batch by batch.
+    """
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self._archive = None
+        self._mtime = int(time.time())
+
+    def existing(self):
+        if not os.path.exists(self.path):
+            return set()
+        with tarfile.open(self.path) as archive:
+            return bottle_ids_in(archive.getnames())
+
+    def add(self, bottle_id, data):
+        if self._archive is None:
+            self._archive = tarfile.open(self.path, "a")
+        info = tarfile.TarInfo(label_file_name(bottle_id, self.fmt))
+        info.size = len(data)
+        info.mtime = self._mtime
+        self._archive.addfile(info, io.BytesIO(data))
+
+    def commit(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def close(self):
+        self.commit()
+
+
+class PdfSink:
+    """
+    Labels laid out in a grid on the pages of a multi-page PDF, for one print job.
+
+    Each full page is appended to the PDF as soon as it is complete and its bottle
+    IDs are recorded in a manifest next to it (<path>.ids), which is what a resumed
+    export skips. Labels of a page that was not written yet are simply rendered again.
+    """
+
+    def __init__(self, path, fmt, columns=4, rows=6, dpi=300):
+        if fmt != "png":
+            raise ValueError("PDF export needs PNG labels")
+        self.path = path
+        self.manifest_path = path + ".ids"
+        self.columns = columns
+        self.rows = rows
+        self.dpi = dpi
+        self._labels = []
+        self.pages = 0
+
+    def existing(self):
+        if not os.path.exists(self.manifest_path) or not os.path.exists(self.path):
+            return set()
+        with open(self.manifest_path) as manifest:
+            return {int(line) for line in manifest if line.strip()}
+
+    def add(self, bottle_id, data):
+        self._labels.append((bottle_id, data))
+        if len(self._labels) == self.columns * self.rows:
+            self._write_page()
+
+    def _write_page(self):
+        images = [Image.open(io.BytesIO(data)) for _, data in self._labels]
+        width, height = images[0].size
+        page = Image.new("1", (width * self.columns, height * self.rows), 1)
+        for index, image in enumerate(images):
+            row, column = divmod(index, self.columns)
+            page.paste(image, (column * width, row * height))
+        page.save(self.path, format="PDF", resolution=self.dpi, append=os.path.exists(self.path))
+        with open(self.manifest_path, "a") as manifest:
+            manifest.writelines(f"{bottle_id}\n" for bottle_id, _ in self._labels)
+        self._labels = []
+        self.pages += 1
+
+    def commit(self):
+        pass
+
+    def close(self):
+        if self._labels:
+            self._write_page()
+
+
+SINKS = {
+    "zip": ZipSink,
+    "tar": TarSink,
+    "pdf": PdfSink,
+}
+
+
+def stream_bottles(conn, first_id=None, last_id=None, tagged_only=False, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yield lists of (Flaschen_ID, Rezept_ID, Tagged_Date) rows in ID order without loading the whole table.
+    """
+    conditions, params = [], []
+    if first_id is not None:
+        conditions.append("Flaschen_ID >= ?")
+        params.append(first_id)
+    if last_id is not None:
+        conditions.append("Flaschen_ID <= ?")
+        params.append(last_id)
+    if tagged_only:
+        conditions.append("Tagged_Date != 0")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor = conn.execute(f"SELECT Flaschen_ID, Rezept_ID, Tagged_Date FROM Flasche {where} ORDER BY Flaschen_ID", params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def render_label(row, fmt, box_size, date):
+    """
+    Worker side: (Flaschen_ID, label file contents) for one Flasche row.
+    """
+    bottle_id, recipe_id, tagged_date = row
+    return bottle_id, encode_qr(label_content(bottle_id, recipe_id, tagged_date or date), fmt, box_size)
+
+
+def export_labels(db_path, sink, fmt="png", box_size=DEFAULT_BOX_SIZE, workers=None, resume=True,
+                  first_id=None, last_id=None, tagged_only=False, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Render the QR labels of all matching bottles into sink. Returns (exported, skipped).
+    """
+    done = sink.existing() if resume else set()
+    if done:
+        logger.info("Resuming, %d labels already exported", len(done))
+    render = partial(render_label, fmt=fmt, box_size=box_size, date=int(time.time()))
+    workers = os.cpu_count() if workers is None else workers
+    executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+    exported = skipped = 0
+
+    # Read-only, the stations may be writing to the database at the same time
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        for rows in stream_bottles(conn, first_id, last_id, tagged_only, batch_size):
+            todo = [row for row in rows if row[0] not in done]
+            skipped += len(rows) - len(todo)
+            if not todo:
+                continue
+            if executor is None:
+                labels = map(render, todo)
+            else:
+                labels = executor.map(render, todo, chunksize=max(1, len(todo) // (workers * 4)))
+            for bottle_id, data in labels:
+                sink.add(bottle_id, data)
+            sink.commit()
+            exported += len(todo)
+            logger.info("Exported %d labels (last Flaschen_ID %d)", exported, todo[-1][0])
+        sink.close()
+    finally:
+        conn.close()
+        if executor is not None:
+            executor.shutdown()
+    return exported, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-generate the QR labels of a production run into one file.")
+    parser.add_argument("output", help="output file; .zip, .tar or .pdf selects the container")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    parser.add_argument("--container", choices=sorted(SINKS), help="override the container chosen by the file extension")
+    parser.add_argument("--qr-format", choices=QR_FORMATS, default="png")
+    parser.add_argument("--box-size", type=int, default=DEFAULT_BOX_SIZE, help="pixels per QR module")
+    parser.add_argument("--from-id", type=int, help="first Flaschen_ID to export")
+    parser.add_argument("--to-id", type=int, help="last Flaschen_ID to export")
+    parser.add_argument("--tagged-only", action="store_true", help="only bottles Station 1 has tagged")
+    parser.add_argument("--workers", type=int, help="render processes, default one per core, 0 renders inline")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--columns", type=int, default=4, help="labels per row on a PDF page")
+    parser.add_argument("--rows", type=int, default=6, help="label rows on a PDF page")
+    parser.add_argument("--restart", action="store_true", help="render every label again instead of resuming")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    container = args.container or os.path.splitext(args.output)[1].lstrip(".").lower()
+    if container not in SINKS:
+        parser.error(f"cannot tell the container from {args.output!r}, use --container")
+    if container == "pdf" and args.qr_format != "png":
+        parser.error("PDF export needs --qr-format png")
+    if args.restart:
+        for path in (args.output, args.output + ".ids"):
+            if os.path.exists(path):
+                os.remove(path)
+    if container == "pdf":
+        sink = PdfSink(args.output, args.qr_format, columns=args.columns, rows=args.rows)
+    else:
+        sink = SINKS[container](args.output, args.qr_format)
+
+    started = time.perf_counter()
+    exported, skipped = export_labels(
+        args.db, sink, fmt=args.qr_format, box_size=args.box_size, workers=args.workers,
+        first_id=args.from_id, last_id=args.to_id, tagged_only=args.tagged_only, batch_size=args.batch_size,
+    )
+    elapsed = time.perf_counter() - started
+    print(f"Exported {exported} labels to {args.output} in {elapsed:.1f} s ({skipped} already present)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# Atomic reservation of untagged bottle IDs so several Station 1 instances can share one database
+from collections import deque
+from contextlib import contextmanager
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import station_db
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds after which an unconfirmed reservation is considered abandoned
+RESERVATION_TTL = 60
+# Pooled IDs are held longer and their reservations are refreshed in the background
+POOL_RESERVATION_TTL = 600
+
+STATE_RESERVED = "reserved"   # ID handed out, tag not written yet
+STATE_WRITTEN = "written"     # ID is on a tag, database not updated yet
+
+
+def default_owner(name="station1"):
+    return f"{name}@{socket.gethostname()}:{os.getpid()}"
+
+
+class IDReservations:
+    """
+    Hands out untagged Flaschen_IDs through the Flaschen_Reservierung table
+    (created by the station_db migrations).
+
+    reserve() claims an ID inside a single BEGIN IMMEDIATE transaction, so two
+    stations can never receive the same ID. mark_written() records that the ID is
+    on a tag, confirm() marks the bottle as tagged and drops the reservation, and
+    release() gives an ID back. Expired reservations are reclaimed on every
+    reserve(): IDs that never reached a tag become free again, IDs that were
+    already written are marked as tagged so they are not handed out twice.
+    written, if given, returns further IDs to treat as written, e.g. those a
+    TaggingWriteBehind has journaled but not committed yet.
+    """
+
+    def __init__(self, conn, owner=None, ttl=RESERVATION_TTL, written=None):
+        self.conn = conn
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.written = written
+
+    @contextmanager
+    def _immediate(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn.cursor()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+
+    def _reclaim_expired(self, cursor, now):
+        if self.written is not None:
+            cursor.executemany('''
+                UPDATE Flaschen_Reservierung
+                SET State = ?
+                WHERE Flaschen_ID = ? AND Expires_At <= ?
+            ''', [(STATE_WRITTEN, bottle_id, now) for bottle_id in self.written()])
+        cursor.execute('''
+            UPDATE Flasche
+            SET Tagged_Date = (
+                SELECT Reserved_At FROM Flaschen_Reservierung r WHERE r.Flaschen_ID = Flasche.Flaschen_ID
+            )
+            WHERE Flaschen_ID IN (
+                SELECT Flaschen_ID FROM Flaschen_Reservierung WHERE State = ? AND Expires_At <= ?
+            ) AND Tagged_Date = 0
+        ''', (STATE_WRITTEN, now))
+        cursor.execute('DELETE FROM Flaschen_Reservierung WHERE Expires_At <= ?', (now,))
+        if cursor.rowcount:
+            logger.warning("Reclaimed %d expired bottle ID reservation(s)", cursor.rowcount)
+
+    def reserve(self):
+        """
+        Claim the first untagged, unreserved bottle. Returns (Flaschen_ID, Rezept_ID),
+        or None if there is none.
+        """
+        reserved = self.reserve_many(1)
+        return reserved[0] if reserved else None
+
+    def reserve_many(self, count):
+        """
+        Claim up to count untagged, unreserved bottles in one transaction and
+        return their (Flaschen_ID, Rezept_ID) pairs.
+        """
+        now = int(time.time())
+        with self._immediate() as cursor:
+            self._reclaim_expired(cursor, now)
+            cursor.execute('''
+                SELECT Flaschen_ID, Rezept_ID
+                FROM Flasche f
+                WHERE Tagged_Date = 0
+                  AND NOT EXISTS (SELECT 1 FROM Flaschen_Reservierung r WHERE r.Flaschen_ID = f.Flaschen_ID)
+                LIMIT ?
+            ''', (count,))
+            reserved = cursor.fetchall()
+            cursor.executemany('''
+                INSERT INTO Flaschen_Reservierung (Flaschen_ID, State, Owner, Reserved_At, Expires_At)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(bottle_id, STATE_RESERVED, self.owner, now, now + self.ttl) for bottle_id, _ in reserved])
+            return reserved
+
+    def extend(self, bottle_ids):
+        """
+        Push back the expiry of reservations this owner still holds.
+        """
+        with self._immediate() as cursor:
+            cursor.executemany('''
+                UPDATE Flaschen_Reservierung
+                SET Expires_At = ?
+                WHERE Flaschen_ID = ? AND Owner = ?
+            ''', [(int(time.time()) + self.ttl, bottle_id, self.owner) for bottle_id in bottle_ids])
+
+    def mark_written(self, bottle_id):
+        with self._immediate() as cursor:
+            cursor.execute('''
+                UPDATE Flaschen_Reservierung
+                SET State = ?, Expires_At = ?
+                WHERE Flaschen_ID = ? AND Owner = ?
+            ''', (STATE_WRITTEN, int(time.time()) + self.ttl, bottle_id, self.owner))
+
+    def confirm(self, bottle_id, tagged_date, tag_uid=None):
+        """
+        Mark the bottle as tagged, record the UID of its tag and drop any reservation
+        for it in one transaction.
+        """
+        self.confirm_many([(bottle_id, tagged_date, tag_uid)])
+
+    def confirm_many(self, results):
+        """
+        Same as confirm() for a list of (bottle_id, tagged_date, tag_uid) triples;
+        tag_uid may be None.
+        """
+        with self._immediate() as cursor:
+            for bottle_id, tagged_date, tag_uid in results:
+                if tag_uid is not None:
+                    # A reused tag belongs to the bottle it was tagged for last
+                    cursor.execute('UPDATE Flasche SET Tag_UID = NULL WHERE Tag_UID = ? AND Flaschen_ID != ?',
+                                   (tag_uid, bottle_id))
+                cursor.execute('''
+                    UPDATE Flasche
+                    SET Tagged_Date = ?, has_error = ?, Tag_UID = COALESCE(?, Tag_UID)
+                    WHERE Flaschen_ID = ?
+                ''', (tagged_date, False, tag_uid, bottle_id))
+            cursor.executemany('DELETE FROM Flaschen_Reservierung WHERE Flaschen_ID = ?',
+                               [(bottle_id,) for bottle_id, _, _ in results])
+
+    def release(self, bottle_id):
+        self.release_many([bottle_id])
+
+    def release_many(self, bottle_ids):
+        with self._immediate() as cursor:
+            cursor.executemany('''
+                DELETE FROM Flaschen_Reservierung
+                WHERE Flaschen_ID = ? AND Owner = ? AND State = ?
+            ''', [(bottle_id, self.owner, STATE_RESERVED) for bottle_id in bottle_ids])
+
+
+class IDPool:
+    """
+    In-memory pool of reserved (Flaschen_ID, Rezept_ID) pairs so Station 1 does not
+    query SQLite per bottle.
+
+    A background thread with its own database connection reserves IDs in blocks of
+    `size` whenever the pool drops to `low_water`, and keeps the reservations of
+    pooled IDs from expiring. take() only touches the pool; close() stops the thread
+    and releases IDs that were never used. written is passed on to IDReservations.
+    """
+
+    def __init__(self, db_path, owner=None, size=20, low_water=5, ttl=POOL_RESERVATION_TTL, trace=None,
+                 written=None):
+        self.db_path = db_path
+        self.owner = owner or default_owner()
+        self.size = size
+        self.low_water = low_water
+        self.ttl = ttl
+        self.trace = trace
+        self.written = written
+        self._ids = deque()
+        self._condition = threading.Condition()
+        self._refill = threading.Event()
+        self._closed = False
+        self._exhausted = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="id-pool", daemon=True)
+        self._thread.start()
+        self._refill.set()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def take(self, timeout=5.0):
+        """
+        Return a reserved (Flaschen_ID, Rezept_ID) pair, or None if the database has
+        no untagged bottles left.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if len(self._ids) <= self.low_water:
+                self._refill.set()
+            while not self._ids:
+                remaining = deadline - time.monotonic()
+                if self._exhausted or self._closed or remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return self._ids.popleft()
+
+    def give_back(self, reserved):
+        """
+        Return a pair from take() whose ID was not written to a tag.
+        """
+        with self._condition:
+            self._ids.appendleft(reserved)
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+        self._refill.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        conn = station_db.connect(self.db_path, migrations=False, trace=self.trace)
+        reservations = IDReservations(conn, owner=self.owner, ttl=self.ttl, written=self.written)
+        try:
+            while True:
+                # Wake up on demand, or often enough to refresh the pooled reservations
+                self._refill.wait(self.ttl / 2)
+                self._refill.clear()
+                with self._condition:
+                    closed = self._closed
+                    pooled = list(self._ids)
+                if closed:
+                    break
+                try:
+                    if pooled:
+                        reservations.extend([bottle_id for bottle_id, _ in pooled])
+                    missing = self.size - len(pooled)
+                    reserved = reservations.reserve_many(missing) if missing > 0 else []
+                except sqlite3.Error as e:
+                    logger.error("Failed to refill bottle ID pool: %s", e)
+                    continue
+                with self._condition:
+                    self._ids.extend(reserved)
+                    self._exhausted = not self._ids
+                    self._condition.notify_all()
+                if reserved:
+                    logger.debug("Reserved %d bottle IDs for the pool", len(reserved))
+        finally:
+            with self._condition:
+                unused = list(self._ids)
+                self._ids.clear()
+            if unused:
+                try:
+                    reservations.release_many([bottle_id for bottle_id, _ in unused])
+                    logger.info("Released %d unused bottle IDs", len(unused))
+                except sqlite3.Error as e:
+                    logger.error("Failed to release unused bottle IDs: %s", e)
+            conn.close()
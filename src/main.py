@@ -1,4 +1,4 @@
-import nfc_reader
+from nfc_reader import NFCReader, iter_image_blocks, logger
 
 if __name__ == "__main__":
 
@@ -13,7 +13,7 @@ if __name__ == "__main__":
         logger.info("Found card with UID: %s", [hex(i) for i in uid])
         break
 
-    blocks_data = nfc_reader.read_all_blocks(uid)
-    for block_number, block_data in enumerate(blocks_data):
+    image = nfc_reader.read_all_blocks(uid)
+    for block_number, block_data in iter_image_blocks(image):
         hex_values = " ".join([f"{byte:02x}" for byte in block_data])
         logger.info("Data in Block %d: %s", block_number, hex_values)
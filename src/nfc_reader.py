@@ -1,10 +1,8 @@
 # Example how to build a NFCReader that implements an Interface
 from abc import ABC, abstractmethod
-import board
-import busio
-from digitalio import DigitalInOut
-from adafruit_pn532.spi import PN532_SPI
 import logging
+import os
+import time
 
 
 # Configure logging
@@ -14,6 +12,49 @@ logger = logging.getLogger(__name__)
 # Constants
 DEFAULT_KEY_A = bytes([0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF])
 BLOCK_COUNT = 64
+BLOCK_SIZE = 16
+BLOCKS_PER_SECTOR = 4
+SECTOR_COUNT = BLOCK_COUNT // BLOCKS_PER_SECTOR
+BACKEND_ENV_VAR = "NFC_READER_BACKEND"
+DEFAULT_BACKEND = "spi"
+# Transport settings; each can also be passed to NFCReader as an option
+SPI_BAUDRATE_ENV_VAR = "NFC_READER_SPI_BAUDRATE"
+SPI_CS_PIN_ENV_VAR = "NFC_READER_SPI_CS"
+I2C_FREQUENCY_ENV_VAR = "NFC_READER_I2C_FREQUENCY"
+UART_PORT_ENV_VAR = "NFC_READER_UART_PORT"
+UART_BAUDRATE_ENV_VAR = "NFC_READER_UART_BAUDRATE"
+DEFAULT_SPI_CS_PIN = "D8"
+DEFAULT_I2C_FREQUENCY = 100000
+DEFAULT_UART_PORT = "/dev/ttyS0"
+DEFAULT_UART_BAUDRATE = 115200     # the PN532's HSU default
+
+
+def sector_of(block_number):
+    return block_number // BLOCKS_PER_SECTOR
+
+
+def is_sector_trailer(block_number):
+    return block_number % BLOCKS_PER_SECTOR == BLOCKS_PER_SECTOR - 1
+
+
+def image_blocks(include_trailers=False):
+    """
+    Block numbers in the order they appear in a card image returned by read_all_blocks.
+    """
+    return [
+        block_number
+        for block_number in range(BLOCK_COUNT)
+        if include_trailers or not is_sector_trailer(block_number)
+    ]
+
+
+def iter_image_blocks(image, include_trailers=False):
+    """
+    Yield (block_number, memoryview) pairs for a card image returned by read_all_blocks.
+    """
+    view = memoryview(image)
+    for index, block_number in enumerate(image_blocks(include_trailers)):
+        yield block_number, view[index * BLOCK_SIZE:(index + 1) * BLOCK_SIZE]
 
 
 class NFCReaderInterface(ABC):
@@ -27,7 +68,7 @@ class NFCReaderInterface(ABC):
         pass
 
     @abstractmethod
-    def read_all_blocks(self, uid):
+    def read_all_blocks(self, uid, include_trailers=False):
         pass
 
     @abstractmethod
@@ -35,8 +76,86 @@ class NFCReaderInterface(ABC):
         pass
 
 
+def set_spi_baudrate(pn532, baudrate):
+    """
+    Change the SPI clock of a PN532_SPI. The bus device applies it from the next transfer on.
+    """
+    pn532._spi.baudrate = int(baudrate)
+
+
+def _build_spi_pn532(baudrate=None, cs_pin=None, spi=None):
+    # Hardware libraries are only importable on the Raspberry Pi
+    import board
+    import busio
+    from digitalio import DigitalInOut
+    from adafruit_pn532.spi import PN532_SPI
+
+    # Unset keeps the driver's default clock; measure with benchmark_transport.py before raising it
+    baudrate = baudrate or os.environ.get(SPI_BAUDRATE_ENV_VAR)
+    cs_pin = cs_pin or os.environ.get(SPI_CS_PIN_ENV_VAR, DEFAULT_SPI_CS_PIN)
+    # Readers with their own chip select pin can share one bus
+    spi = spi or busio.SPI(board.SCK, board.MOSI, board.MISO)
+    pn532 = PN532_SPI(spi, DigitalInOut(getattr(board, cs_pin)), debug=False)
+    if baudrate:
+        set_spi_baudrate(pn532, baudrate)
+    logger.info("PN532 on SPI, chip select %s, %s Hz", cs_pin, baudrate or "default")
+    return pn532
+
+
+def _build_i2c_pn532(frequency=None):
+    import board
+    import busio
+    from adafruit_pn532.i2c import PN532_I2C
+
+    # On the Raspberry Pi the bus clock is set by the kernel (dtparam=i2c_arm_baudrate)
+    frequency = int(frequency or os.environ.get(I2C_FREQUENCY_ENV_VAR, DEFAULT_I2C_FREQUENCY))
+    i2c = busio.I2C(board.SCL, board.SDA, frequency=frequency)
+    logger.info("PN532 on I2C, %d Hz", frequency)
+    return PN532_I2C(i2c, debug=False)
+
+
+def _build_uart_pn532(port=None, baudrate=None):
+    import serial
+    from adafruit_pn532.uart import PN532_UART
+
+    port = port or os.environ.get(UART_PORT_ENV_VAR, DEFAULT_UART_PORT)
+    baudrate = int(baudrate or os.environ.get(UART_BAUDRATE_ENV_VAR, DEFAULT_UART_BAUDRATE))
+    uart = serial.Serial(port, baudrate=baudrate, timeout=0.1)
+    logger.info("PN532 on UART %s, %d baud", port, baudrate)
+    return PN532_UART(uart, debug=False)
+
+
+def _build_sim_pn532():
+    from pn532_sim import SimulatedPN532
+
+    return SimulatedPN532.from_env()
+
+
+# Transports NFCReader can talk to, selected by name
+BACKENDS = {
+    "spi": _build_spi_pn532,
+    "i2c": _build_i2c_pn532,
+    "uart": _build_uart_pn532,
+    "sim": _build_sim_pn532,
+}
+# The adafruit_pn532 constructors already read firmware_version and fail if the chip does not answer
+PROBING_BACKENDS = frozenset({"spi", "i2c", "uart"})
+
+
 class NFCReader(NFCReaderInterface):
-    def __init__(self):
+    def __init__(self, backend=None, pn532=None, options=None):
+        """
+        backend selects an entry of BACKENDS and defaults to the NFC_READER_BACKEND
+        environment variable, then "spi". options are passed to the backend's
+        builder, e.g. {"baudrate": 2000000, "cs_pin": "D7"} for SPI; settings not
+        given come from the NFC_READER_* environment variables. An already
+        constructed pn532 object (e.g. a SimulatedPN532) can be passed in instead.
+        """
+        # (uid, sector) the PN532 currently holds an authentication for
+        self._auth_session = None
+        self.backend = backend or os.environ.get(BACKEND_ENV_VAR, DEFAULT_BACKEND)
+        self.options = options or {}
+        self._pn532 = pn532
         self._pn532 = self.config()
 
     def __getattr__(self, name):
@@ -47,12 +166,20 @@ class NFCReader(NFCReaderInterface):
 
     def config(self):
         try:
-            spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
-            cs_pin = DigitalInOut(board.D8)
-            pn532 = PN532_SPI(spi, cs_pin, debug=False)
+            pn532 = self._pn532
+            probed = False
+            if pn532 is None:
+                if self.backend not in BACKENDS:
+                    raise ValueError(f"Unknown NFC reader backend '{self.backend}'")
+                pn532 = BACKENDS[self.backend](**self.options)
+                probed = self.backend in PROBING_BACKENDS
 
-            ic, ver, rev, support = pn532.firmware_version
-            logger.info("Found PN532 with firmware version: %d.%d", ver, rev)
+            if probed:
+                # No second firmware exchange for a chip its driver has just probed
+                logger.info("Found PN532 on %s", self.backend)
+            else:
+                ic, ver, rev, support = pn532.firmware_version
+                logger.info("Found PN532 with firmware version: %d.%d", ver, rev)
 
             # Configure PN532 to communicate with MiFare cards
             pn532.SAM_configuration()
@@ -61,52 +188,149 @@ class NFCReader(NFCReaderInterface):
             logger.error("Failed to configure PN532: %s", e)
             raise
 
+    def is_alive(self):
+        """
+        Probe the PN532; False means the reader no longer answers.
+        """
+        try:
+            self._pn532.firmware_version
+            return True
+        except Exception as e:
+            logger.error("PN532 did not answer: %s", e)
+            return False
+
+    def read_passive_target(self, *args, **kwargs):
+        """
+        Detect a card. Selecting a card, even the same one again, resets its
+        authentication state, so the cached session is dropped first.
+        """
+        self.invalidate_auth()
+        return self._pn532.read_passive_target(*args, **kwargs)
+
+    def wait_for_removal(self, uid, debounce=0.2, poll_timeout=0.05, timeout=None):
+        """
+        Block until the card with the given uid has left the field.
+
+        The field is polled with short read_passive_target timeouts. A different
+        card ends the wait at once; an empty field only counts once it has stayed
+        empty for `debounce` seconds, so a single missed poll is not taken for a
+        removal. Returns False if the card is still there after `timeout` seconds.
+        """
+        uid = bytes(uid)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        absent_since = None
+        while True:
+            current = self.read_passive_target(timeout=poll_timeout)
+            now = time.monotonic()
+            if current is not None and bytes(current) != uid:
+                return True
+            if current is not None:
+                absent_since = None
+            elif absent_since is None:
+                absent_since = now
+            if absent_since is not None and now - absent_since >= debounce:
+                return True
+            if deadline is not None and now >= deadline:
+                return False
+
+    def invalidate_auth(self):
+        self._auth_session = None
+
+    def _authenticate(self, uid, block_number):
+        """
+        Authenticate the sector containing block_number, reusing the current
+        session if the same card and sector are already authenticated.
+        """
+        session = (bytes(uid), sector_of(block_number))
+        if self._auth_session == session:
+            return True
+
+        self._auth_session = None
+        if not self._pn532.mifare_classic_authenticate_block(
+            uid, block_number, 0x60, key=DEFAULT_KEY_A
+        ):
+            return False
+        self._auth_session = session
+        return True
+
     def read_block(self, uid, block_number):
         try:
-            authenticated = self._pn532.mifare_classic_authenticate_block(
-                uid, block_number, 0x60, key=DEFAULT_KEY_A
-            )
-            if not authenticated:
+            if not self._authenticate(uid, block_number):
                 logger.error("Failed to authenticate block %d", block_number)
                 return None
 
             block_data = self._pn532.mifare_classic_read_block(block_number)
             if block_data is None:
+                self.invalidate_auth()
                 logger.error("Failed to read block %d", block_number)
                 return None
 
             return block_data
         except Exception as e:
+            self.invalidate_auth()
             logger.exception("Error reading block %d: %s", block_number, e)
             return None
 
-    def read_all_blocks(self, uid):
-        blocks_data = []
-        for block_number in range(BLOCK_COUNT):
-            block_data = self.read_block(uid, block_number)
-            if block_data:
-                blocks_data.append(block_data)
-            else:
-                logger.warning("No data read from Block %d", block_number)
-        return blocks_data
+    def read_all_blocks(self, uid, include_trailers=False):
+        """
+        Read the whole card into one contiguous bytearray.
+
+        MIFARE Classic only needs one authentication per 4-block sector, so each
+        sector is authenticated once and its blocks are read back to back. Sector
+        trailers are skipped unless include_trailers is set; use iter_image_blocks
+        to map the image back to block numbers. Blocks that cannot be read are left
+        zero-filled.
+        """
+        image = bytearray(len(image_blocks(include_trailers)) * BLOCK_SIZE)
+        offset = 0
+        for sector in range(SECTOR_COUNT):
+            first_block = sector * BLOCKS_PER_SECTOR
+            sector_blocks = [
+                block_number
+                for block_number in range(first_block, first_block + BLOCKS_PER_SECTOR)
+                if include_trailers or not is_sector_trailer(block_number)
+            ]
+            try:
+                authenticated = self._authenticate(uid, first_block)
+            except Exception as e:
+                self.invalidate_auth()
+                logger.exception("Error authenticating sector %d: %s", sector, e)
+                authenticated = False
+            if not authenticated:
+                logger.warning("Failed to authenticate sector %d", sector)
+                offset += len(sector_blocks) * BLOCK_SIZE
+                continue
+
+            for block_number in sector_blocks:
+                try:
+                    block_data = self._pn532.mifare_classic_read_block(block_number)
+                except Exception as e:
+                    logger.exception("Error reading block %d: %s", block_number, e)
+                    block_data = None
+                if block_data:
+                    image[offset:offset + BLOCK_SIZE] = block_data
+                else:
+                    self.invalidate_auth()
+                    logger.warning("No data read from Block %d", block_number)
+                offset += BLOCK_SIZE
+        return image
 
     def write_block(self, uid, block_number, data):
         try:
-            authenticated = self._pn532.mifare_classic_authenticate_block(
-                uid, block_number, 0x60, key=DEFAULT_KEY_A
-            )
-            if not authenticated:
+            if not self._authenticate(uid, block_number):
                 logger.error("Failed to authenticate block %d for writing", block_number)
                 return False
 
             success = self._pn532.mifare_classic_write_block(block_number, data)
             if not success:
+                self.invalidate_auth()
                 logger.error("Failed to write to block %d", block_number)
                 return False
 
             logger.info("Successfully wrote data to block %d", block_number)
             return True
         except Exception as e:
+            self.invalidate_auth()
             logger.exception("Error writing block %d: %s", block_number, e)
             return False
 
@@ -124,7 +348,7 @@ if __name__ == "__main__":
         logger.info("Found card with UID: %s", [hex(i) for i in uid])
         break
 
-    blocks_data = nfc_reader.read_all_blocks(uid)
-    for block_number, block_data in enumerate(blocks_data):
+    image = nfc_reader.read_all_blocks(uid)
+    for block_number, block_data in iter_image_blocks(image):
         hex_values = " ".join([f"{byte:02x}" for byte in block_data])
         logger.info("Data in Block %d: %s", block_number, hex_values)
@@ -0,0 +1,221 @@
+# In-memory PN532 with simulated MIFARE Classic cards, used when no reader hardware is attached
+from collections import Counter, deque
+import logging
+import os
+import random
+import time
+
+from nfc_reader import (
+    BLOCK_COUNT,
+    BLOCK_SIZE,
+    DEFAULT_KEY_A,
+    is_sector_trailer,
+    sector_of,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Default sector trailer: key A, access bits for transport configuration, key B
+DEFAULT_TRAILER = DEFAULT_KEY_A + bytes([0xFF, 0x07, 0x80, 0x69]) + bytes([0xFF] * 6)
+
+# Approximate command/response times of a PN532 on SPI at 1 MHz with a MIFARE Classic 1K card
+DEFAULT_LATENCY = {
+    "firmware_version": 0.004,
+    "SAM_configuration": 0.004,
+    "read_passive_target": 0.020,
+    "mifare_classic_authenticate_block": 0.008,
+    "mifare_classic_read_block": 0.006,
+    "mifare_classic_write_block": 0.012,
+}
+
+
+class SimulatedCard:
+    def __init__(self, uid, blocks=None):
+        self.uid = bytes(uid)
+        if blocks is None:
+            blocks = [bytearray(BLOCK_SIZE) for _ in range(BLOCK_COUNT)]
+            bcc = 0
+            for byte in self.uid:
+                bcc ^= byte
+            blocks[0][:len(self.uid) + 1] = self.uid + bytes([bcc])
+            for block_number in range(BLOCK_COUNT):
+                if is_sector_trailer(block_number):
+                    blocks[block_number][:] = DEFAULT_TRAILER
+        self.blocks = blocks
+
+    @classmethod
+    def random(cls, rng=random):
+        return cls(bytes(rng.randrange(256) for _ in range(4)))
+
+    def key_a(self, sector):
+        return bytes(self.blocks[sector * 4 + 3][:6])
+
+
+class SimulatedPN532:
+    """
+    Stand-in for adafruit_pn532's PN532 exposing the subset NFCReader uses.
+
+    Cards queued with add_card enter the field one after another. With dwell set,
+    each card leaves the field dwell seconds after arriving and the next one arrives
+    gap seconds later; without it a card stays until remove_card is called.
+    auth_failure_rate and removal_rate inject failed authentications and cards that
+    are pulled in the middle of a command. Every command sleeps for its configured
+    latency and is counted in command_counts.
+    """
+
+    def __init__(self, cards=(), latency=None, auth_failure_rate=0.0, removal_rate=0.0,
+                 dwell=None, gap=0.0, seed=None, clock=time.monotonic, sleep=time.sleep):
+        self.latency = dict(DEFAULT_LATENCY)
+        if latency is not None:
+            if isinstance(latency, dict):
+                self.latency.update(latency)
+            else:
+                self.latency = {command: float(latency) for command in self.latency}
+        self.auth_failure_rate = auth_failure_rate
+        self.removal_rate = removal_rate
+        self.dwell = dwell
+        self.gap = gap
+        self.command_counts = Counter()
+        self._rng = random.Random(seed)
+        self._clock = clock
+        self._sleep = sleep
+        self._queue = deque(cards)
+        self._card = None
+        self._card_since = None
+        self._next_arrival = None
+        self._selected = None
+        self._auth_sector = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a simulator from NFC_SIM_* environment variables.
+        """
+        seed = os.environ.get("NFC_SIM_SEED")
+        rng = random.Random(seed)
+        dwell = os.environ.get("NFC_SIM_DWELL", "1.0")
+        return cls(
+            cards=[SimulatedCard.random(rng) for _ in range(int(os.environ.get("NFC_SIM_CARDS", "10")))],
+            latency=float(os.environ["NFC_SIM_LATENCY"]) if "NFC_SIM_LATENCY" in os.environ else None,
+            auth_failure_rate=float(os.environ.get("NFC_SIM_AUTH_FAILURE_RATE", "0")),
+            removal_rate=float(os.environ.get("NFC_SIM_REMOVAL_RATE", "0")),
+            dwell=float(dwell) if dwell else None,
+            gap=float(os.environ.get("NFC_SIM_GAP", "0.5")),
+            seed=seed,
+        )
+
+    # Field control
+
+    def add_card(self, card):
+        self._queue.append(card)
+
+    def remove_card(self):
+        if self._card is not None:
+            logger.debug("Simulated card %s left the field", self._card.uid.hex())
+        self._card = None
+        self._selected = None
+        self._auth_sector = None
+        self._next_arrival = self._clock() + self.gap
+
+    @property
+    def card(self):
+        self._update_field()
+        return self._card
+
+    @property
+    def pending_cards(self):
+        return len(self._queue)
+
+    def _update_field(self):
+        now = self._clock()
+        if self._card is not None and self.dwell is not None and now - self._card_since >= self.dwell:
+            self.remove_card()
+            self._next_arrival = self._card_since + self.dwell + self.gap
+        if self._card is None and self._queue:
+            if self._next_arrival is None:
+                self._next_arrival = now
+            if now >= self._next_arrival:
+                self._card = self._queue.popleft()
+                self._card_since = now
+
+    def _command(self, name):
+        self.command_counts[name] += 1
+        delay = self.latency.get(name, 0)
+        if delay:
+            self._sleep(delay)
+        self._update_field()
+        if self._selected is not None and self._card is not self._selected:
+            self._selected = None
+            self._auth_sector = None
+
+    def _maybe_remove(self):
+        if self._card is not None and self.removal_rate and self._rng.random() < self.removal_rate:
+            self.remove_card()
+            return True
+        return False
+
+    # PN532 API
+
+    @property
+    def firmware_version(self):
+        self._command("firmware_version")
+        return (0x32, 1, 6, 7)
+
+    def SAM_configuration(self):
+        self._command("SAM_configuration")
+
+    def read_passive_target(self, card_baud=0x00, timeout=1):
+        self._command("read_passive_target")
+        deadline = self._clock() + timeout
+        while True:
+            self._update_field()
+            if self._card is not None:
+                self._selected = self._card
+                self._auth_sector = None
+                return bytearray(self._card.uid)
+
+            now = self._clock()
+            if now >= deadline:
+                self._selected = None
+                return None
+            wake = deadline
+            if self._queue and self._next_arrival is not None:
+                wake = min(wake, max(self._next_arrival, now))
+            self._sleep(max(wake - now, 0.001))
+
+    def mifare_classic_authenticate_block(self, uid, block_number, key_number, key):
+        self._command("mifare_classic_authenticate_block")
+        card = self._selected
+        if card is None or self._maybe_remove() or bytes(uid) != card.uid:
+            return False
+        sector = sector_of(block_number)
+        if self._rng.random() < self.auth_failure_rate or bytes(key) != card.key_a(sector):
+            # A failed authentication halts the card until it is selected again
+            self._selected = None
+            self._auth_sector = None
+            return False
+        self._auth_sector = sector
+        return True
+
+    def mifare_classic_read_block(self, block_number):
+        self._command("mifare_classic_read_block")
+        if not self._can_access(block_number):
+            return None
+        return bytearray(self._selected.blocks[block_number])
+
+    def mifare_classic_write_block(self, block_number, data):
+        self._command("mifare_classic_write_block")
+        if len(data) != BLOCK_SIZE or block_number == 0 or not self._can_access(block_number):
+            return False
+        self._selected.blocks[block_number][:] = data
+        return True
+
+    def _can_access(self, block_number):
+        if self._selected is None or self._maybe_remove():
+            return False
+        if self._auth_sector != sector_of(block_number):
+            self._selected = None
+            self._auth_sector = None
+            return False
+        return True
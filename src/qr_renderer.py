@@ -0,0 +1,188 @@
+# QR code rendering for Station 2 on a bounded worker pool
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import lru_cache
+import io
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+QR_FORMATS = ("png", "svg")
+DEFAULT_BOX_SIZE = 10
+DEFAULT_BORDER = 4
+DEFAULT_WORKERS = 1
+# Bottles whose QR code may still be rendering before submit() blocks the station
+DEFAULT_MAX_PENDING = 16
+MATRIX_CACHE_SIZE = 256
+
+
+@lru_cache(maxsize=MATRIX_CACHE_SIZE)
+def qr_matrix(content, border=DEFAULT_BORDER):
+    """
+    Module matrix of a QR code including its quiet zone, as a tuple of rows of booleans.
+    Cached, so repeated content (retries, reprints) skips the Reed-Solomon encoding.
+    """
+    # qrcode and PIL take longer to import than the rest of Station 2; load them on first use
+    import qrcode
+
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, border=border)
+    qr.add_data(content)
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
+
+
+def label_content(bottle_id, recipe_id, date):
+    """
+    Text encoded in a bottle's QR code.
+    """
+    return f"Flaschen_ID: {bottle_id}, Rezept_ID: {recipe_id}, Date: {date}"
+
+
+def label_file_name(bottle_id, fmt="png"):
+    return f"qr_bottle_{bottle_id}.{fmt}"
+
+
+def qr_image(matrix, box_size=DEFAULT_BOX_SIZE):
+    """
+    1-bit image of a QR matrix, box_size pixels per module.
+    """
+    from PIL import Image
+
+    size = len(matrix)
+    image = Image.new("1", (size, size))
+    image.putdata([0 if dark else 1 for row in matrix for dark in row])
+    if box_size != 1:
+        image = image.resize((size * box_size, size * box_size), Image.NEAREST)
+    return image
+
+
+def png_bytes(matrix, box_size=DEFAULT_BOX_SIZE):
+    buffer = io.BytesIO()
+    qr_image(matrix, box_size).save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def svg_bytes(matrix, box_size=DEFAULT_BOX_SIZE):
+    """
+    SVG with one path for all dark modules.
+    """
+    size = len(matrix)
+    modules = "".join(f"M{x},{y}h1v1h-1z" for y, row in enumerate(matrix) for x, dark in enumerate(row) if dark)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size * box_size}" height="{size * box_size}" '
+        f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<rect width="{size}" height="{size}" fill="#fff"/><path d="{modules}" fill="#000"/></svg>\n'
+    ).encode()
+
+
+ENCODERS = {
+    "png": png_bytes,
+    "svg": svg_bytes,
+}
+
+
+def encode_qr(content, fmt="png", box_size=DEFAULT_BOX_SIZE, border=DEFAULT_BORDER):
+    """
+    QR code of content as PNG or SVG file contents.
+    """
+    return ENCODERS[fmt](qr_matrix(content, border), box_size)
+
+
+def render_qr(content, path, fmt="png", box_size=DEFAULT_BOX_SIZE, border=DEFAULT_BORDER):
+    """
+    Render content as a QR code to path. The file appears atomically, so a reader
+    never sees a half-written label. Returns path.
+    """
+    data = encode_qr(content, fmt, box_size, border)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as qr_file:
+        qr_file.write(data)
+    os.replace(temp_path, path)
+    return path
+
+
+class QRRenderer:
+    """
+    Renders QR codes off the station's hot path.
+
+    submit() hands the job to a thread or process pool and returns a Future for the
+    file path. At most max_pending jobs are outstanding; beyond that submit() blocks
+    so a stalled SD card slows the station down instead of queueing without bound.
+    With workers=0 every job is rendered synchronously inside submit().
+    """
+
+    def __init__(self, output_dir="qr_codes", fmt="png", workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+                 box_size=DEFAULT_BOX_SIZE, border=DEFAULT_BORDER, processes=False):
+        if fmt not in QR_FORMATS:
+            raise ValueError(f"Unknown QR code format {fmt!r}, expected one of {', '.join(QR_FORMATS)}")
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.workers = workers
+        self.box_size = box_size
+        self.border = border
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._executor = None
+        if workers:
+            if processes:
+                from concurrent.futures import ProcessPoolExecutor
+                self._executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.rendered = 0
+        self.failed = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def path_for(self, bottle_id):
+        return os.path.join(self.output_dir, label_file_name(bottle_id, self.fmt))
+
+    def metrics(self):
+        """
+        (name, type, value, help) of every metric, see StationMetrics.
+        """
+        return [
+            ("pending", "gauge", self.pending, "QR codes queued or being rendered."),
+            ("rendered_total", "counter", self.rendered, "QR codes written."),
+            ("failed_total", "counter", self.failed, "QR codes that could not be rendered."),
+        ]
+
+    def submit(self, bottle_id, content, callback=None):
+        """
+        Queue the QR code of one bottle. callback(future) runs once the file is written or rendering failed.
+        """
+        path = self.path_for(bottle_id)
+        self._slots.acquire()
+        with self._lock:
+            self.pending += 1
+        if self._executor is None:
+            future = Future()
+            try:
+                future.set_result(render_qr(content, path, self.fmt, self.box_size, self.border))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self._executor.submit(render_qr, content, path, self.fmt, self.box_size, self.border)
+        future.add_done_callback(self._done)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            if future.exception() is None:
+                self.rendered += 1
+            else:
+                self.failed += 1
+                logger.error("QR code rendering failed: %s", future.exception())
+        self._slots.release()
+
+    def close(self):
+        """
+        Wait for outstanding QR codes and shut the pool down.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,167 @@
+# Several PN532 readers on one SPI bus, each driving its own station lane
+import argparse
+import logging
+import signal
+import threading
+import time
+
+from nfc_reader import BACKENDS, NFCReader, _build_spi_pn532
+from station_files import load_station
+from station_metrics import PN532_COMMANDS, serve_metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = "/home/maxsim/maxsim-NFC-raspi/data/flaschen_database.db"
+# Longest a lane holds the bus while polling an empty field
+DEFAULT_POLL_SLICE = 0.05
+
+
+class FairBusLock:
+    """
+    Lock for a shared bus that is granted in the order it was requested.
+
+    A lane that keeps polling for cards therefore cannot starve one that is in
+    the middle of reading or writing a tag: every waiting lane gets the bus
+    before the poller gets it again.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self.wait_seconds = 0.0
+        self.transactions = 0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._condition.wait()
+            self.wait_seconds += time.perf_counter() - started
+            self.transactions += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._serving += 1
+            self._condition.notify_all()
+
+
+class SharedBusPN532:
+    """
+    Wraps a PN532 on a shared bus so that every command holds the bus lock.
+
+    read_passive_target is split into polls of at most poll_slice seconds with the
+    bus released in between, so waiting for a bottle on one lane only delays the
+    other lanes by one slice.
+    """
+
+    def __init__(self, pn532, bus_lock, poll_slice=DEFAULT_POLL_SLICE):
+        self._pn532 = pn532
+        self._bus_lock = bus_lock
+        self.poll_slice = poll_slice
+
+    def __getattr__(self, name):
+        if name not in PN532_COMMANDS:
+            return getattr(self._pn532, name)
+        if isinstance(getattr(type(self._pn532), name, None), property):
+            # A property such as firmware_version talks to the chip on access
+            with self._bus_lock:
+                return getattr(self._pn532, name)
+        command = getattr(self._pn532, name)
+
+        def locked(*args, **kwargs):
+            with self._bus_lock:
+                return command(*args, **kwargs)
+        return locked
+
+    def read_passive_target(self, card_baud=0x00, timeout=1):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._bus_lock:
+                uid = self._pn532.read_passive_target(card_baud, min(self.poll_slice, max(deadline - time.monotonic(), 0)))
+            if uid is not None or time.monotonic() >= deadline:
+                return uid
+
+
+class ReaderManager:
+    """
+    One NFCReader per chip select pin, all on the same SPI bus.
+
+    The readers' commands are serialized through a FairBusLock. With the "sim"
+    backend every lane gets its own simulated PN532, still sharing the lock, so
+    the scheduling can be tried without hardware.
+    """
+
+    def __init__(self, cs_pins, backend="spi", baudrate=None, poll_slice=DEFAULT_POLL_SLICE):
+        if backend not in ("spi", "sim"):
+            raise ValueError(f"Readers on backend '{backend}' cannot share a bus")
+        self.cs_pins = list(cs_pins)
+        self.bus_lock = FairBusLock()
+        self.readers = []
+        if backend == "spi":
+            import board
+            import busio
+
+            spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
+        for cs_pin in self.cs_pins:
+            if backend == "spi":
+                pn532 = _build_spi_pn532(baudrate, cs_pin, spi=spi)
+            else:
+                pn532 = BACKENDS["sim"]()
+            shared = SharedBusPN532(pn532, self.bus_lock, poll_slice)
+            self.readers.append(NFCReader(backend=backend, pn532=shared))
+            logger.info("Reader %d ready on chip select %s", len(self.readers), cs_pin)
+
+
+def run_lanes(machines):
+    """
+    Run every machine in its own thread until all of them have stopped.
+    """
+    threads = [threading.Thread(target=machine.run, name=f"lane-{machine.lane}") for machine in machines]
+    for thread in threads:
+        thread.start()
+    # Joining with a timeout keeps the main thread responsive to signals
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(0.5)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one station lane per PN532 reader on a shared SPI bus.")
+    parser.add_argument("--station", type=int, choices=[1, 2], required=True)
+    parser.add_argument("--cs-pins", default="D8,D7", help="comma separated chip select pins, one lane each")
+    parser.add_argument("--backend", choices=["spi", "sim"], default="spi")
+    parser.add_argument("--baudrate", type=int, help="SPI clock of all readers")
+    parser.add_argument("--poll-slice", type=float, default=DEFAULT_POLL_SLICE,
+                        help="longest time in seconds a lane holds the bus while waiting for a card")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running after idle timeouts and transient errors")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the metrics of lane N on http://127.0.0.1:PORT+N-1/metrics")
+    args = parser.parse_args(argv)
+
+    station = load_station(args.station)
+    manager = ReaderManager(args.cs_pins.split(","), backend=args.backend, baudrate=args.baudrate,
+                            poll_slice=args.poll_slice)
+    machines = [station.StateMachine(args.db, nfc_reader=reader, daemon=args.daemon, lane=lane)
+                for lane, reader in enumerate(manager.readers, start=1)]
+    if args.metrics_port:
+        for machine in machines:
+            serve_metrics(machine.metrics, args.metrics_port + machine.lane - 1)
+
+    def stop(signum, frame):
+        for machine in machines:
+            machine.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    run_lanes(machines)
+    logger.info("Bus lock: %d transactions, %.3f s waited", manager.bus_lock.transactions, manager.bus_lock.wait_seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# In-memory cache of recipe contents for Station 2
+import logging
+
+from tag_record import recipe_digest
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecipeCache:
+    """
+    Maps Rezept_ID to a tuple of (Granulat_ID, Menge) pairs, loaded once at startup.
+
+    Before each lookup PRAGMA data_version tells whether any other connection has
+    committed since the last check. Only then is the Rezept_Version counter read,
+    which the station_db triggers bump on every change to
+    Rezept_besteht_aus_Granulat, and the cache is reloaded if it moved.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._recipes = {}
+        self._digests = {}
+        self._data_version = None
+        self._recipe_version = None
+        self.reloads = 0
+
+    def _read_recipe_version(self):
+        return self.conn.execute("SELECT Version FROM Rezept_Version WHERE ID = 1").fetchone()[0]
+
+    def load(self):
+        recipes = {}
+        for recipe_id, granule_id, quantity in self.conn.execute('''
+            SELECT Rezept_ID, Granulat_ID, Menge
+            FROM Rezept_besteht_aus_Granulat
+            ORDER BY Rezept_ID, rowid
+        '''):
+            recipes.setdefault(recipe_id, []).append((granule_id, quantity))
+        self._recipes = {recipe_id: tuple(items) for recipe_id, items in recipes.items()}
+        self._digests = {recipe_id: recipe_digest(items) for recipe_id, items in self._recipes.items()}
+        self._data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self._recipe_version = self._read_recipe_version()
+        self.reloads += 1
+        logger.info("Loaded %d recipes into the cache", len(self._recipes))
+
+    def _refresh(self):
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        if self._read_recipe_version() != self._recipe_version:
+            self.load()
+
+    def _ensure_current(self):
+        if self._recipe_version is None:
+            self.load()
+        else:
+            self._refresh()
+
+    def get(self, recipe_id):
+        """
+        Return the (Granulat_ID, Menge) pairs of a recipe, or an empty tuple if it is unknown.
+        """
+        self._ensure_current()
+        return self._recipes.get(recipe_id, ())
+
+    def digest(self, recipe_id):
+        """
+        Return the tag_record digest of a recipe's current contents, or None if it is unknown.
+        """
+        self._ensure_current()
+        return self._digests.get(recipe_id)
+
+    def bottle_for_uid(self, uid):
+        """
+        (Flaschen_ID, Rezept_ID) of the bottle tagged last with this tag UID, or None.
+        """
+        return self.conn.execute('SELECT Flaschen_ID, Rezept_ID FROM Flasche WHERE Tag_UID = ?', (bytes(uid),)).fetchone()
+
+    def recipe_id_for_bottle(self, bottle_id):
+        """
+        Primary key lookup of a bottle's Rezept_ID, or None if the bottle is unknown.
+        """
+        row = self.conn.execute('SELECT Rezept_ID FROM Flasche WHERE Flaschen_ID = ?', (bottle_id,)).fetchone()
+        return row[0] if row else None
@@ -14,6 +14,16 @@ def reset_database(db_path):
             UPDATE Flasche
             SET Tagged_Date = 0, has_error = 0
         ''')
+
+        # Forget the tag UIDs recorded by Station 1, if the column exists
+        cursor.execute("SELECT 1 FROM pragma_table_info('Flasche') WHERE name = 'Tag_UID'")
+        if cursor.fetchone():
+            cursor.execute("UPDATE Flasche SET Tag_UID = NULL")
+
+        # Drop outstanding Station 1 ID reservations, if the table exists
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'Flaschen_Reservierung'")
+        if cursor.fetchone():
+            cursor.execute("DELETE FROM Flaschen_Reservierung")
         conn.commit()
         print("Database reset successfully!")
     
@@ -1,35 +1,84 @@
+import argparse
 import logging
 import os
+import signal
 import sqlite3
 from datetime import datetime
+from id_reservation import IDPool, IDReservations, default_owner
 from nfc_reader import NFCReader
+from recipe_cache import RecipeCache
+from event_log import EventRecorder
+import station_db
+import station_logging
+from station_metrics import StationMetrics, serve_metrics
+import station_profiler
+from station_pipeline import WorkerStage
+import tag_record
+from uid_cache import RecentUIDs
+from write_behind import TaggingWriteBehind
+from station_errors import Backoff, FatalError, IdleTimeout, RecoverableError, classify_error
 import time
 
-# Configure the main logger
-logging.basicConfig(level=logging.DEBUG)
+# Queued, rotating station1.log; file and console output are written by a background thread
+station1_logger, log_file_path = station_logging.station_logger("Station1Logger", "station1.log")
 
-log_directory = "/home/maxsim/maxsim-NFC-raspi/logging"
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-
-log_file_path = os.path.join(log_directory, "station1.log")
-
-# Configure a separate logger for station1.log
-station1_logger = logging.getLogger("Station1Logger")
-station1_handler = logging.FileHandler(log_file_path)
-station1_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-station1_handler.setFormatter(station1_formatter)
-station1_logger.addHandler(station1_handler)
-station1_logger.setLevel(logging.DEBUG)
+# Seconds the field has to stay empty before a bottle counts as removed
+REMOVAL_DEBOUNCE = 0.2
+# Timeout of a single read_passive_target poll while waiting for removal
+REMOVAL_POLL_TIMEOUT = 0.05
+# Consecutive recoverable errors after which the reader is probed for hardware loss
+PROBE_AFTER_FAILURES = 3
+# Bottle IDs reserved ahead of time, and the fill level at which the pool is refilled
+ID_POOL_SIZE = 20
+ID_POOL_LOW_WATER = 5
+# Tagging results are journaled here and committed to the database in batches
+JOURNAL_FILE_NAME = "station1_tagging.journal"
+# Bottles the worker stage may fall behind by; 0 finishes every bottle inline
+PIPELINE_DEPTH = 8
+# Recently tagged UIDs remembered, and for how many seconds, so a lingering bottle needs no tag or database I/O
+UID_CACHE_SIZE = 256
+UID_CACHE_TTL = 30.0
 
 class StateMachine:
-    def __init__(self, db_path):
+    def __init__(self, db_path, nfc_reader=None, removal_debounce=REMOVAL_DEBOUNCE, removal_timeout=None,
+                 daemon=False, id_pool_size=ID_POOL_SIZE, write_behind=True, journal_path=None,
+                 event_log=True, lane=None, pipeline_depth=PIPELINE_DEPTH, uid_cache_size=UID_CACHE_SIZE,
+                 uid_cache_ttl=UID_CACHE_TTL):
         self.current_state = 'State0'
-        self.nfc_reader = None
+        # Set when several readers run in one process, see reader_manager.py
+        self.lane = lane
+        self.nfc_reader = nfc_reader
         self.uid = None
         self.bottle_id = None
+        self.recipe_id = None
+        self.tagged_at = None
         self.db_path = db_path
+        self.removal_debounce = removal_debounce
+        self.removal_timeout = removal_timeout
+        # In daemon mode only fatal errors end run(); reader and database stay open
+        self.daemon = daemon
+        self.backoff = Backoff()
+        self.stop_requested = False
+        # Error passed to fail() by the state that ran last, for the event log
+        self.last_error = None
         self.conn = None
+        self.reservations = None
+        self.recipe_cache = None
+        self.id_pool_size = id_pool_size
+        self.id_pool = None
+        self.write_behind = write_behind
+        journal_name = JOURNAL_FILE_NAME if lane is None else f"station1_lane{lane}_tagging.journal"
+        self.journal_path = journal_path or os.path.join(os.path.dirname(os.path.abspath(db_path)), journal_name)
+        # Lanes reserve IDs under their own owner so one lane never confirms another's
+        self.owner = None if lane is None else default_owner(f"station1-lane{lane}")
+        self.tagging_writer = None
+        self.pipeline_depth = pipeline_depth
+        self.pipeline = None
+        # The worker stage's own connection
+        self.worker_conn = None
+        self.worker_reservations = None
+        # uid -> (Flaschen_ID, Tagged_Date) of the bottles tagged or found tagged last
+        self.recent_uids = RecentUIDs(uid_cache_size, uid_cache_ttl)
         self.states = {
             'State0': State0(self),
             'State1': State1(self),
@@ -38,24 +87,170 @@ class StateMachine:
             'State4': State4(self),
             'State5': State5(self)
         }
+        # Called as listener(state, next_state, seconds) after every state run
+        self.metrics = StationMetrics(self, station=1, lane=lane)
+        self.listeners = [self.metrics]
+        self.event_recorder = EventRecorder(self, station=1) if event_log else None
+        if self.event_recorder is not None:
+            self.listeners.append(self.event_recorder)
 
     def connect_db(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            # WAL/synchronous=NORMAL profile; also applies pending schema migrations
+            self.conn = station_db.connect(self.db_path, trace=self.metrics.record_query)
+            self.reservations = IDReservations(self.conn, owner=self.owner)
+            # Digests of the recipes written to the tags alongside the Rezept_ID
+            self.recipe_cache = RecipeCache(self.conn)
+            self.recipe_cache.load()
+            if self.write_behind:
+                # Replays results a previous run journaled but did not commit
+                self.tagging_writer = TaggingWriteBehind(self.db_path, self.journal_path,
+                                                         owner=self.reservations.owner,
+                                                         trace=self.metrics.record_query,
+                                                         logger=station1_logger)
+                self.tagging_writer.start()
+                # An ID journaled as written is reclaimed as tagged, never handed out again
+                self.reservations.written = self.tagging_writer.journaled
+            if self.id_pool_size:
+                self.id_pool = IDPool(self.db_path, owner=self.reservations.owner,
+                                      size=self.id_pool_size, low_water=min(ID_POOL_LOW_WATER, self.id_pool_size - 1),
+                                      trace=self.metrics.record_query,
+                                      written=self.reservations.written)
+                self.id_pool.start()
+            if self.pipeline_depth and self.tagging_writer is None:
+                # With write-behind the commit already happens off the tag I/O thread
+                pipeline = WorkerStage("station1-worker", depth=self.pipeline_depth,
+                                       on_start=self.open_worker_db, on_stop=self.close_worker_db,
+                                       on_error=self.confirm_failed)
+                # Raises if the worker could not open its connection
+                pipeline.start()
+                self.pipeline = pipeline
             return True
         except sqlite3.Error as e:
             station1_logger.error(f"Database connection error: {e}")
             return False
 
+    def open_worker_db(self):
+        self.worker_conn = station_db.connect(self.db_path, migrations=False, trace=self.metrics.record_query)
+        self.worker_reservations = IDReservations(self.worker_conn, owner=self.reservations.owner)
+
+    def close_worker_db(self):
+        if self.worker_conn is not None:
+            self.worker_conn.close()
+
+    def wait_for_card_removal(self):
+        """
+        Block until the current bottle has left the reader instead of sleeping a fixed time.
+        """
+        if self.nfc_reader.wait_for_removal(
+            self.uid,
+            debounce=self.removal_debounce,
+            poll_timeout=REMOVAL_POLL_TIMEOUT,
+            timeout=self.removal_timeout,
+        ):
+            station1_logger.info("Card removed, ready for the next bottle")
+        else:
+            station1_logger.warning("Card still present after waiting for its removal")
+
+    def fail(self, error, retry_state='State1', fallback_state='State5'):
+        """
+        Pick the next state after an error. Without daemon mode the station goes to
+        fallback_state. In daemon mode idle timeouts go straight back to waiting,
+        recoverable errors retry retry_state after a backoff delay, and only a
+        reader that stops answering is fatal.
+        """
+        self.last_error = error
+        if not self.daemon:
+            self.current_state = fallback_state
+            return
+
+        error = classify_error(error)
+        if isinstance(error, IdleTimeout):
+            station1_logger.info("No bottle arrived, still waiting")
+            self.current_state = 'State1'
+            return
+        if isinstance(error, RecoverableError) and self.backoff.attempts >= PROBE_AFTER_FAILURES:
+            if not self.nfc_reader.is_alive():
+                error = FatalError("RFID reader stopped responding")
+        if isinstance(error, FatalError):
+            station1_logger.critical(f"Fatal error, stopping station: {error}")
+            self.current_state = 'State5'
+            return
+
+        delay = self.backoff.next_delay()
+        station1_logger.warning(f"Recoverable error, retrying in {delay:.2f} s: {error}")
+        time.sleep(delay)
+        self.current_state = retry_state
+
+    def stop(self):
+        """
+        Ask run() to return after the current state.
+        """
+        self.stop_requested = True
+
+    def reserve_bottle_id(self):
+        """
+        Return a reserved (Flaschen_ID, Rezept_ID) pair, or None if no bottle is left.
+        """
+        if self.id_pool is not None:
+            return self.id_pool.take()
+        return self.reservations.reserve()
+
+    def release_bottle_id(self, bottle_id, recipe_id):
+        if self.id_pool is not None:
+            self.id_pool.give_back((bottle_id, recipe_id))
+        else:
+            self.reservations.release(bottle_id)
+
+    def tagging_pending(self, bottle_id):
+        if self.pipeline is not None and self.pipeline.is_pending(bottle_id):
+            return True
+        return self.tagging_writer is not None and self.tagging_writer.is_pending(bottle_id)
+
+    def confirm_on_worker(self, bottle_id, tagged_date, tag_uid):
+        # Runs on the worker stage, on its own connection
+        self.worker_reservations.confirm(bottle_id, tagged_date, tag_uid)
+        station1_logger.info(f"Bottle ID: {bottle_id} tagged successfully.")
+
+    def confirm_failed(self, bottle_id, error):
+        # The tag is written and its ID marked as written, but the bottle is not confirmed
+        station1_logger.error(f"Database update failed for Bottle ID {bottle_id}: {error}")
+        if self.event_recorder is not None:
+            self.event_recorder.record_failure('State3', error, bottle_id=bottle_id)
+
+    def event_fields(self, state):
+        fields = {
+            "uid": self.uid.hex() if self.uid else None,
+            "bottle_id": self.bottle_id,
+            "recipe_id": self.recipe_id,
+        }
+        if state == 'State3':
+            fields["tagged_at"] = self.tagged_at
+        return fields
+
     def close_db(self):
+        if self.pipeline is not None:
+            # Finishes the bottles handed to the worker stage
+            self.pipeline.close()
+        if self.id_pool is not None:
+            # Hands unused IDs back to the database
+            self.id_pool.close()
+        if self.tagging_writer is not None:
+            # Commits tagging results that are still queued
+            self.tagging_writer.close()
         if self.conn:
             self.conn.close()
 
     def run(self):
         try:
-            while self.current_state not in ['State5']:
-                state = self.states[self.current_state]
-                state.run()
+            while self.current_state not in ['State5'] and not self.stop_requested:
+                state_name = self.current_state
+                self.last_error = None
+                started = time.perf_counter()
+                self.states[state_name].run()
+                elapsed = time.perf_counter() - started
+                for listener in self.listeners:
+                    listener(state_name, self.current_state, elapsed)
         finally:
             self.close_db()
 
@@ -70,7 +265,8 @@ class State0(State):
     def run(self):
         station1_logger.info("Initializing RFID reader and database connection...")
         try:
-            self.machine.nfc_reader = NFCReader()   # Initialize the NFC reader
+            if self.machine.nfc_reader is None:
+                self.machine.nfc_reader = NFCReader()   # Initialize the NFC reader
             if self.machine.connect_db():   # Connect to the database
                 station1_logger.info("Initialization successful")
                 self.machine.current_state = 'State1'
@@ -86,25 +282,35 @@ class State1(State):
         try:
             uid = self.machine.nfc_reader.read_passive_target(timeout=10)
             if uid is None:
-                raise Exception("Timeout occurred while waiting for RFID card.")
+                raise IdleTimeout("Timeout occurred while waiting for RFID card.")
             self.machine.uid = bytes(uid)  # Convert to bytes only if uid is not None
+            self.machine.bottle_id = self.machine.recipe_id = None
             station1_logger.info(f"Card detected: {[hex(i) for i in self.machine.uid]}")
             self.machine.current_state = 'State2'
-            time.sleep(1)  # Add a 1-second wait
         except Exception as e:
-            logging.error(f"Card reading error: {e}")
-            station1_logger.error(f"Card reading error: {e}")  # Log to station1.log
-            print(f"Card reading error: {e}")  # Print to terminal
-            self.machine.current_state = 'State5'  # Transition to State5
+            if not (self.machine.daemon and isinstance(e, IdleTimeout)):
+                logging.error(f"Card reading error: {e}")
+                station1_logger.error(f"Card reading error: {e}")  # Log to station1.log
+                print(f"Card reading error: {e}")  # Print to terminal
+            self.machine.fail(e)
 
 class State2(State):
     def run(self):
         station1_logger.info("Checking if the RFID chip is already tagged...")
         try:
+            recent = self.machine.recent_uids.get(self.machine.uid)
+            if recent is not None:
+                # Still in the field or presented again shortly after being handled
+                self.machine.bottle_id, tagged_date = recent
+                station1_logger.info(f"Bottle ID {self.machine.bottle_id} already tagged on {tagged_date} (seen recently)")
+                self.machine.wait_for_card_removal()
+                self.machine.current_state = 'State1'
+                return
+
             block_number = 2
             data = self.machine.nfc_reader.read_block(self.machine.uid, block_number)
             if data and any(data):
-                self.machine.bottle_id = int.from_bytes(data, byteorder='big')
+                self.machine.bottle_id = tag_record.bottle_id_from_block(data)
                 cursor = self.machine.conn.cursor()
                 cursor.execute('''
                     SELECT Flaschen_ID, Tagged_Date 
@@ -113,71 +319,111 @@ class State2(State):
                 ''', (self.machine.bottle_id,))
                 result = cursor.fetchone()
 
-                if result:
-                    station1_logger.info(f"Bottle ID {result[0]} already tagged on {result[1]}")
-                    time.sleep(2)  # Add a 2-second wait before retrying
+                if result or self.machine.tagging_pending(self.machine.bottle_id):
+                    tagged_date = result[1] if result else "(database update pending)"
+                    station1_logger.info(f"Bottle ID {self.machine.bottle_id} already tagged on {tagged_date}")
+                    self.machine.recent_uids.put(self.machine.uid, (self.machine.bottle_id, tagged_date))
+                    self.machine.wait_for_card_removal()
                     self.machine.current_state = 'State1'  # Return to waiting for new RFID
                     return
                 else:
                     station1_logger.info(f"Bottle ID {self.machine.bottle_id} found in block but not tagged in database")
+                    self.machine.tagged_at = int(time.time())
                     self.machine.current_state = 'State3'
             else:
-                station1_logger.info("Block 2 is empty, fetching an untagged bottle ID...")
-                cursor = self.machine.conn.cursor()
-                cursor.execute('''
-                    SELECT Flaschen_ID
-                    FROM Flasche 
-                    WHERE Tagged_Date = 0
-                    LIMIT 1
-                ''')
-                result = cursor.fetchone()
+                station1_logger.info("Block 2 is empty, reserving an untagged bottle ID...")
+                reserved = self.machine.reserve_bottle_id()
 
-                if not result:
+                if reserved is None:
                     station1_logger.error("No available bottles found")
-                    self.machine.current_state = 'State5'
+                    self.machine.fail(RecoverableError("No available bottles found"))
                     return
 
-                self.machine.bottle_id = result[0]
-                data = self.machine.bottle_id.to_bytes(16, byteorder='big')
-                if self.machine.nfc_reader.write_block(self.machine.uid, block_number, data):
+                self.machine.bottle_id, self.machine.recipe_id = reserved
+                # The tag carries the recipe so Station 2 can dispense without the database
+                self.machine.tagged_at = int(time.time())
+                data = tag_record.encode(tag_record.TagRecord(
+                    self.machine.bottle_id,
+                    self.machine.recipe_id,
+                    self.machine.tagged_at,
+                    tag_record.recipe_digest(self.machine.recipe_cache.get(self.machine.recipe_id)),
+                ))
+                writer = self.machine.tagging_writer
+                if writer is not None:
+                    # The journal entry is the only per-bottle write to disk; from here on the
+                    # ID counts as written, so an expired reservation cannot hand it out again
+                    writer.journal_written(self.machine.bottle_id, self.machine.tagged_at, self.machine.uid)
+                try:
+                    written = self.machine.nfc_reader.write_block(self.machine.uid, block_number, data)
+                except Exception:
+                    if writer is not None:
+                        # The tag may carry the ID now; commit it as tagged like a replayed entry
+                        writer.submit(self.machine.bottle_id, str(self.machine.tagged_at), self.machine.uid)
+                    raise
+                if written:
+                    if writer is None:
+                        # Until the bottle is confirmed, only this keeps an expired reservation
+                        # of an ID that is on a tag from being handed out again
+                        self.machine.reservations.mark_written(self.machine.bottle_id)
                     station1_logger.info(f"Bottle ID {self.machine.bottle_id} written to RFID chip.")
                     self.machine.current_state = 'State3'
                 else:
+                    if writer is not None:
+                        writer.cancel(self.machine.bottle_id)
+                    self.machine.release_bottle_id(self.machine.bottle_id, self.machine.recipe_id)
                     raise Exception("Failed to write Bottle ID to RFID chip")
 
         except Exception as e:
             station1_logger.error(f"Error during bottle tagging process: {e}")
-            self.machine.current_state = 'State1'
+            self.machine.fail(e, fallback_state='State1')
+            if not self.machine.daemon:
+                # Without the backoff of daemon mode the same tag would be retried at full speed
+                try:
+                    self.machine.wait_for_card_removal()
+                except Exception as removal_error:
+                    station1_logger.error(f"Error while waiting for card removal: {removal_error}")
 
 class State3(State):
     def run(self):
         station1_logger.info("Updating database...")
         try:
-            cursor = self.machine.conn.cursor()
-            # Get current Unix timestamp (seconds since epoch)
-            unix_timestamp = str(int(time.time()))
-
-            cursor.execute('''
-                UPDATE Flasche 
-                SET Tagged_Date = ?, has_error = ?
-                WHERE Flaschen_ID = ?
-            ''', (unix_timestamp, False, self.machine.bottle_id))
-            self.machine.conn.commit()
-
-            # Log filling quantities to station1.log
-            station1_logger.info(f"Bottle ID: {self.machine.bottle_id} tagged successfully.")
+            # Same Unix timestamp as the one written to the tag in State2
+            unix_timestamp = str(self.machine.tagged_at)
+
+            if self.machine.tagging_writer is not None:
+                # Already journaled in State2, committed with the next batch
+                self.machine.tagging_writer.submit(self.machine.bottle_id, unix_timestamp, self.machine.uid)
+                station1_logger.debug(f"Tagging results queued: {self.machine.tagging_writer.queue_depth}")
+                station1_logger.info(f"Bottle ID: {self.machine.bottle_id} tagged successfully.")
+            elif self.machine.pipeline is not None:
+                # Committed by the worker stage while the next bottle is tagged, which logs the
+                # result. The ID is already marked as written, so it is not handed out again if this fails.
+                self.machine.pipeline.submit(self.machine.bottle_id, self.machine.confirm_on_worker,
+                                             self.machine.bottle_id, unix_timestamp, self.machine.uid)
+                station1_logger.info(f"Bottle ID: {self.machine.bottle_id} queued for the database update.")
+            else:
+                # Marks the bottle as tagged, records the tag's UID and drops its reservation in one transaction
+                self.machine.reservations.confirm(self.machine.bottle_id, unix_timestamp, self.machine.uid)
+                station1_logger.info(f"Bottle ID: {self.machine.bottle_id} tagged successfully.")
+
             station1_logger.info(f"Timestamp: {unix_timestamp}")
+            self.machine.recent_uids.put(self.machine.uid, (self.machine.bottle_id, unix_timestamp))
 
             self.machine.current_state = 'State4'
         except Exception as e:
             station1_logger.error(f"Database update failed: {e}")
-            self.machine.current_state = 'State5'
+            self.machine.fail(e, retry_state='State3')
 
 class State4(State):
     def run(self):
         station1_logger.info("Process completed for one bottle, proceeding to next...")
-        time.sleep(2)  # Add a 2-second wait before restarting the process
-        self.machine.current_state = 'State1'
+        try:
+            self.machine.current_state = 'State1'
+            self.machine.backoff.reset()
+            self.machine.wait_for_card_removal()
+        except Exception as e:
+            station1_logger.error(f"Error while waiting for card removal: {e}")
+            self.machine.fail(e)
 
 class State5(State):
     def run(self):
@@ -186,6 +432,35 @@ class State5(State):
         self.machine.current_state = 'State5'  # End of process
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Station 1: write bottle IDs to RFID tags")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running after idle timeouts and transient errors")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--uid-cache-size", type=int, default=UID_CACHE_SIZE,
+                        help="recently tagged UIDs to remember, 0 disables the cache")
+    parser.add_argument("--uid-cache-ttl", type=float, default=UID_CACHE_TTL,
+                        help="seconds a tagged UID is remembered")
+    parser.add_argument("--no-write-behind", action="store_true",
+                        help="commit every tagging result on its own instead of journaling it for a batch")
+    parser.add_argument("--pipeline-depth", type=int, default=PIPELINE_DEPTH,
+                        help="without write-behind: bottles the database worker may fall behind by, 0 commits inline")
+    station_profiler.add_arguments(parser)
+    args = parser.parse_args()
+
     DB_PATH = "/home/maxsim/maxsim-NFC-raspi/data/flaschen_database.db"
-    machine = StateMachine(DB_PATH)
-    machine.run()
\ No newline at end of file
+    machine = StateMachine(DB_PATH, daemon=args.daemon, write_behind=not args.no_write_behind,
+                           pipeline_depth=args.pipeline_depth, uid_cache_size=args.uid_cache_size,
+                           uid_cache_ttl=args.uid_cache_ttl)
+    if args.metrics_port:
+        serve_metrics(machine.metrics, args.metrics_port)
+    signal.signal(signal.SIGTERM, lambda signum, frame: machine.stop())
+    if args.profile:
+        profiler = station_profiler.ProfileSession.from_args(machine, station=1, args=args)
+        profiler.start()
+        try:
+            machine.run()
+        finally:
+            print(f"Profile written to {profiler.dump()}")
+    else:
+        machine.run()
@@ -1,38 +1,72 @@
-import os
-import logging
+import argparse
+import signal
 import sqlite3
 from datetime import datetime
-import qrcode
 from nfc_reader import NFCReader
+from qr_renderer import QR_FORMATS, QRRenderer, label_content
+from recipe_cache import RecipeCache
+from event_log import EventRecorder
+import station_db
+import station_logging
+from station_metrics import StationMetrics, serve_metrics
+import station_profiler
+from station_pipeline import WorkerStage
+import tag_record
+from uid_cache import RecentUIDs
+from station_errors import Backoff, FatalError, IdleTimeout, RecoverableError, classify_error
 import time
 
-# Configure the main logger
-logging.basicConfig(level=logging.DEBUG)
+# Queued, rotating station2.log; file and console output are written by a background thread
+station2_logger, log_file_path = station_logging.station_logger("Station2Logger", "station2.log")
 
-# Directory and file paths for logs
-log_directory = "/home/maxsim/maxsim-NFC-raspi/logging"
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-
-log_file_path = os.path.join(log_directory, "station2.log")
-
-# Configure a separate logger for station2.log
-station2_logger = logging.getLogger("Station2Logger")
-station2_handler = logging.FileHandler(log_file_path)
-station2_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-station2_handler.setFormatter(station2_formatter)
-station2_logger.addHandler(station2_handler)
-station2_logger.setLevel(logging.DEBUG)
+# Seconds the field has to stay empty before a bottle counts as removed
+REMOVAL_DEBOUNCE = 0.2
+# Timeout of a single read_passive_target poll while waiting for removal
+REMOVAL_POLL_TIMEOUT = 0.05
+# Consecutive recoverable errors after which the reader is probed for hardware loss
+PROBE_AFTER_FAILURES = 3
+# QR codes are rendered on background workers; 0 renders them inline in State4
+QR_WORKERS = 1
+QR_DIRECTORY = "qr_codes"
+# Bottles the worker stage may fall behind by; 0 finishes every bottle inline
+PIPELINE_DEPTH = 8
+# Recently filled UIDs remembered, and for how many seconds, so a lingering bottle gets no second QR code
+UID_CACHE_SIZE = 256
+UID_CACHE_TTL = 30.0
 
 class StateMachine:
-    def __init__(self, db_path):
+    def __init__(self, db_path, nfc_reader=None, removal_debounce=REMOVAL_DEBOUNCE, removal_timeout=None,
+                 daemon=False, qr_workers=QR_WORKERS, qr_format="png", qr_processes=False,
+                 event_log=True, lane=None, pipeline_depth=PIPELINE_DEPTH, verify_tag=False,
+                 uid_cache_size=UID_CACHE_SIZE, uid_cache_ttl=UID_CACHE_TTL):
         self.current_state = 'State0'
-        self.nfc_reader = None
+        # Set when several readers run in one process, see reader_manager.py
+        self.lane = lane
+        self.nfc_reader = nfc_reader
         self.uid = None
         self.bottle_id = None
         self.recipe = []
+        self.recipe_id = None
+        self.tag_record = None
+        # Read the tag even when its UID is known, and prefer what it says
+        self.verify_tag = verify_tag
         self.db_path = db_path
+        self.removal_debounce = removal_debounce
+        self.removal_timeout = removal_timeout
+        # In daemon mode only fatal errors end run(); reader and database stay open
+        self.daemon = daemon
+        self.backoff = Backoff()
+        self.stop_requested = False
+        # Error passed to fail() by the state that ran last, for the event log
+        self.last_error = None
         self.conn = None
+        self.recipe_cache = None
+        self.qr_renderer = QRRenderer(QR_DIRECTORY, fmt=qr_format, workers=qr_workers, processes=qr_processes)
+        # Logs each bottle's recipe and queues its QR code while the next bottle is read
+        self.pipeline = (WorkerStage("station2-worker", depth=pipeline_depth, on_error=self.output_failed)
+                         if pipeline_depth else None)
+        # uid -> (Flaschen_ID, Rezept_ID) of the bottles handled last
+        self.recent_uids = RecentUIDs(uid_cache_size, uid_cache_ttl)
         self.states = {
             'State0': State0(self),
             'State1': State1(self),
@@ -41,24 +75,112 @@ class StateMachine:
             'State4': State4(self),
             'State5': State5(self)
         }
+        # Called as listener(state, next_state, seconds) after every state run
+        self.metrics = StationMetrics(self, station=2, lane=lane)
+        self.listeners = [self.metrics]
+        self.event_recorder = EventRecorder(self, station=2) if event_log else None
+        if self.event_recorder is not None:
+            self.listeners.append(self.event_recorder)
 
     def connect_db(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            # WAL/synchronous=NORMAL profile; also applies pending schema migrations
+            self.conn = station_db.connect(self.db_path, trace=self.metrics.record_query)
+            self.recipe_cache = RecipeCache(self.conn)
+            self.recipe_cache.load()
+            if self.pipeline is not None:
+                self.pipeline.start()
             return True
         except sqlite3.Error as e:
             station2_logger.error(f"Database connection error: {e}")
             return False
 
+    def wait_for_card_removal(self):
+        """
+        Block until the current bottle has left the reader instead of sleeping a fixed time.
+        """
+        if self.nfc_reader.wait_for_removal(
+            self.uid,
+            debounce=self.removal_debounce,
+            poll_timeout=REMOVAL_POLL_TIMEOUT,
+            timeout=self.removal_timeout,
+        ):
+            station2_logger.info("Card removed, ready for the next bottle")
+        else:
+            station2_logger.warning("Card still present after waiting for its removal")
+
+    def fail(self, error, retry_state='State1', fallback_state='State5'):
+        """
+        Pick the next state after an error. Without daemon mode the station goes to
+        fallback_state. In daemon mode idle timeouts go straight back to waiting,
+        recoverable errors retry retry_state after a backoff delay, and only a
+        reader that stops answering is fatal.
+        """
+        self.last_error = error
+        if not self.daemon:
+            self.current_state = fallback_state
+            return
+
+        error = classify_error(error)
+        if isinstance(error, IdleTimeout):
+            station2_logger.info("No bottle arrived, still waiting")
+            self.current_state = 'State1'
+            return
+        if isinstance(error, RecoverableError) and self.backoff.attempts >= PROBE_AFTER_FAILURES:
+            if not self.nfc_reader.is_alive():
+                error = FatalError("RFID reader stopped responding")
+        if isinstance(error, FatalError):
+            station2_logger.critical(f"Fatal error, stopping station: {error}")
+            self.current_state = 'State5'
+            return
+
+        delay = self.backoff.next_delay()
+        station2_logger.warning(f"Recoverable error, retrying in {delay:.2f} s: {error}")
+        time.sleep(delay)
+        self.current_state = retry_state
+
+    def output_failed(self, bottle_id, error):
+        # Runs on the worker stage, after State4 has already moved on
+        station2_logger.error(f"Output failed for Bottle ID {bottle_id}: {error}")
+        if self.event_recorder is not None:
+            self.event_recorder.record_failure('State4', error, bottle_id=bottle_id)
+
+    def stop(self):
+        """
+        Ask run() to return after the current state.
+        """
+        self.stop_requested = True
+
+    def event_fields(self, state):
+        fields = {
+            "uid": self.uid.hex() if self.uid else None,
+            "bottle_id": self.bottle_id,
+            "recipe_id": self.recipe_id,
+        }
+        if state == 'State4':
+            # What the bottle was filled with
+            fields["recipe"] = [[granule_id, quantity] for granule_id, quantity in self.recipe]
+        return fields
+
     def close_db(self):
+        if self.pipeline is not None:
+            # Finishes the bottles handed to the worker stage
+            self.pipeline.close()
+        # Waits for QR codes that are still being rendered
+        self.qr_renderer.close()
         if self.conn:
             self.conn.close()
 
     def run(self):
         try:
-            while self.current_state not in ['State5']:
-                state = self.states[self.current_state]
-                state.run()
+            while self.current_state not in ['State5'] and not self.stop_requested:
+                state_name = self.current_state
+                self.last_error = None
+                started = time.perf_counter()
+                self.states[state_name].run()
+                elapsed = time.perf_counter() - started
+                for listener in self.listeners:
+                    listener(state_name, self.current_state, elapsed)
         finally:
             self.close_db()
 
@@ -73,7 +195,8 @@ class State0(State):
     def run(self):
         station2_logger.info("Initializing RFID reader and database connection...")
         try:
-            self.machine.nfc_reader = NFCReader()
+            if self.machine.nfc_reader is None:
+                self.machine.nfc_reader = NFCReader()
             if self.machine.connect_db():
                 station2_logger.info("Initialization successful")
                 self.machine.current_state = 'State1'
@@ -90,112 +213,147 @@ class State1(State):
             self.machine.uid = self.machine.nfc_reader.read_passive_target(timeout=10)
             if self.machine.uid:
                 self.machine.uid = bytes(self.machine.uid)
+                self.machine.bottle_id = self.machine.recipe_id = self.machine.tag_record = None
                 station2_logger.info(f"Card detected: {[hex(i) for i in self.machine.uid]}")
                 self.machine.current_state = 'State2'
-                time.sleep(1)  # Add a 1-second wait
             else:
-                raise Exception("Timeout occurred while waiting for RFID card.")
+                raise IdleTimeout("Timeout occurred while waiting for RFID card.")
         except Exception as e:
-            station2_logger.error(f"Card reading error: {e}")
-            self.machine.current_state = 'State5'
+            if not (self.machine.daemon and isinstance(e, IdleTimeout)):
+                station2_logger.error(f"Card reading error: {e}")
+            self.machine.fail(e)
 
 class State2(State):
     def run(self):
-        station2_logger.info("Fetching bottle information from RFID chip...")
+        station2_logger.info("Fetching bottle information...")
         try:
+            recent = self.machine.recent_uids.get(self.machine.uid)
+            if recent is not None:
+                # Still in the field or presented again shortly after being handled
+                self.machine.bottle_id, self.machine.recipe_id = recent
+                station2_logger.info(f"Bottle ID {self.machine.bottle_id} already handled (seen recently)")
+                self.machine.wait_for_card_removal()
+                self.machine.current_state = 'State1'
+                return
+
+            # Station 1 records the tag's UID, so one index lookup replaces authenticating and reading the tag
+            known = self.machine.recipe_cache.bottle_for_uid(self.machine.uid)
+            if known is not None and not self.machine.verify_tag:
+                self.machine.bottle_id, self.machine.recipe_id = known
+                station2_logger.info(f"Bottle ID {self.machine.bottle_id} found by tag UID.")
+                self.machine.current_state = 'State3'
+                return
+
             block_number = 2
             data = self.machine.nfc_reader.read_block(self.machine.uid, block_number)
             if data and any(data):
-                self.machine.bottle_id = int.from_bytes(data, byteorder='big')
+                # None for tags written before the versioned record; raises on a CRC mismatch
+                self.machine.tag_record = tag_record.decode(data)
+                self.machine.bottle_id = tag_record.bottle_id_from_block(data)
                 station2_logger.info(f"Bottle ID {self.machine.bottle_id} read from RFID chip.")
+                if known is not None and known[0] != self.machine.bottle_id:
+                    station2_logger.warning(f"Tag UID belongs to Bottle ID {known[0]} in the database, using the tag")
+                elif known is not None:
+                    self.machine.recipe_id = known[1]
                 self.machine.current_state = 'State3'
             else:
                 station2_logger.error("No valid Bottle ID found on RFID chip")
-                self.machine.current_state = 'State5'
+                self.machine.fail(RecoverableError("No valid Bottle ID found on RFID chip"))
         except Exception as e:
             station2_logger.error(f"Error reading Bottle ID from RFID chip: {e}")
-            self.machine.current_state = 'State5'
+            self.machine.fail(e)
 
 class State3(State):
     def run(self):
         station2_logger.info("Fetching recipe details from the database...")
         try:
-            cursor = self.machine.conn.cursor()
-            self.machine.recipe = self.get_recipe(cursor)
+            self.machine.recipe = self.get_recipe()
             if self.machine.recipe:
                 self.machine.current_state = 'State4'
             else:
                 station2_logger.error(f"No recipe found for Bottle ID {self.machine.bottle_id}")
-                self.machine.current_state = 'State5'
+                self.machine.fail(RecoverableError(f"No recipe found for Bottle ID {self.machine.bottle_id}"))
         except Exception as e:
             station2_logger.error(f"Database query failed: {e}")
-            self.machine.current_state = 'State5'
+            self.machine.fail(e)
+
+    def get_recipe(self):
+        record = self.machine.tag_record
+        cache = self.machine.recipe_cache
+        if self.machine.recipe_id is not None:
+            # Looked up with the bottle by tag UID, Flasche.Rezept_ID is always current
+            return cache.get(self.machine.recipe_id)
+        if record is not None and cache.digest(record.recipe_id) == record.recipe_digest:
+            # The recipe on the tag is still current, no database lookup needed
+            station2_logger.info(f"Using Recipe ID {record.recipe_id} from RFID chip")
+            self.machine.recipe_id = record.recipe_id
+            return cache.get(record.recipe_id)
+        if record is not None:
+            station2_logger.warning(f"Recipe {record.recipe_id} changed since tagging, looking up Bottle ID {self.machine.bottle_id}")
 
-    def get_recipe(self, cursor):
         station2_logger.info(f"Fetching recipe for Bottle ID {self.machine.bottle_id}...")
-        cursor.execute('''
-            SELECT Granulat_ID, Menge 
-            FROM Rezept_besteht_aus_Granulat 
-            WHERE Rezept_ID = (
-                SELECT Rezept_ID 
-                FROM Flasche 
-                WHERE Flaschen_ID = ?
-            )
-        ''', (self.machine.bottle_id,))
-        return cursor.fetchall()
+        # One primary key lookup per bottle; the recipe contents come from the cache
+        self.machine.recipe_id = self.machine.recipe_cache.recipe_id_for_bottle(self.machine.bottle_id)
+        if self.machine.recipe_id is None:
+            return ()
+        return self.machine.recipe_cache.get(self.machine.recipe_id)
 
 class State4(State):
     def run(self):
         station2_logger.info("Outputting recipe information and generating QR code...")
         try:
-            # Log and print the recipe
-            bottle_log = f"Filling details for Bottle ID: {self.machine.bottle_id}\n"
-            for granule_id, quantity in self.machine.recipe:
-                log_message = f"Granule ID: {granule_id}, Quantity: {quantity}"
-                station2_logger.info(log_message)
-                bottle_log += log_message + "\n"
-                print(log_message)
-
-            # Fetch the Recipe ID and generate a QR code
-            cursor = self.machine.conn.cursor()
-            cursor.execute('''
-                SELECT f.Rezept_ID 
-                FROM Flasche f 
-                WHERE f.Flaschen_ID = ?
-            ''', (self.machine.bottle_id,))
-            result = cursor.fetchone()
-
-            if not result:
+            # Generate a QR code with the Recipe ID looked up in State3
+            recipe_id = self.machine.recipe_id
+            if recipe_id is None:
                 raise Exception(f"No Recipe ID found for Bottle ID {self.machine.bottle_id}")
-            
-            recipe_id = result[0]
+
             date = int(datetime.now().timestamp())
+            if self.machine.pipeline is not None:
+                # Output runs on the worker stage; blocks only if the worker is a full queue behind
+                self.machine.pipeline.submit(self.machine.bottle_id, self.output,
+                                             self.machine.bottle_id, recipe_id, self.machine.recipe, date)
+            else:
+                self.output(self.machine.bottle_id, recipe_id, self.machine.recipe, date)
 
-            # Create the QR code content
-            qr_content = f"Flaschen_ID: {self.machine.bottle_id}, Rezept_ID: {recipe_id}, Date: {date}"
-            qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-            qr.add_data(qr_content)
-            qr.make(fit=True)
+            self.machine.recent_uids.put(self.machine.uid, (self.machine.bottle_id, recipe_id))
+            self.machine.current_state = 'State1'
+            self.machine.backoff.reset()
+            self.machine.wait_for_card_removal()
 
-            qr_directory = "qr_codes"
-            os.makedirs(qr_directory, exist_ok=True)
-            qr_file_path = os.path.join(qr_directory, f"qr_bottle_{self.machine.bottle_id}.png")
-            qr_image = qr.make_image(fill_color="black", back_color="white")
-            qr_image.save(qr_file_path)
-            station2_logger.info(f"QR code generated and saved at {qr_file_path}")
+        except Exception as e:
+            station2_logger.error(f"Error during QR code generation: {e}")
+            self.machine.fail(e)
 
-            bottle_log += f"QR Code saved at: {qr_file_path}\n"
-            bottle_log += "-" * 40 + "\n"
+    def output(self, bottle_id, recipe_id, recipe, date):
+        """
+        Log and print the recipe of one bottle and queue its QR code.
+        """
+        bottle_log = f"Filling details for Bottle ID: {bottle_id}\n"
+        for granule_id, quantity in recipe:
+            log_message = f"Granule ID: {granule_id}, Quantity: {quantity}"
+            station2_logger.info(log_message)
+            bottle_log += log_message + "\n"
+            print(log_message)
 
-            with open(log_file_path, "a") as log_file:
-                log_file.write(bottle_log)
+        # Create the QR code content
+        qr_content = label_content(bottle_id, recipe_id, date)
 
-            self.machine.current_state = 'State1'
-            time.sleep(2)  # Add a 2-second wait
+        # Rendered and written by the QR workers while the next bottle is handled
+        self.machine.qr_renderer.submit(bottle_id, qr_content, callback=self.qr_done)
+        qr_file_path = self.machine.qr_renderer.path_for(bottle_id)
+        station2_logger.info(f"QR code queued for {qr_file_path}")
 
-        except Exception as e:
-            station2_logger.error(f"Error during QR code generation: {e}")
-            self.machine.current_state = 'State5'
+        bottle_log += f"QR Code saved at: {qr_file_path}\n"
+        bottle_log += "-" * 40
+
+        # One queued record instead of reopening the log file for every bottle
+        station2_logger.info(bottle_log)
+
+    def qr_done(self, future):
+        if future.exception() is None:
+            station2_logger.info(f"QR code generated and saved at {future.result()}")
+        else:
+            station2_logger.error(f"Error during QR code generation: {future.exception()}")
 
 class State5(State):
     def run(self):
@@ -204,6 +362,42 @@ class State5(State):
         self.machine.current_state = 'State5'  # End of process
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Station 2: determine filling quantities from RFID tags")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running after idle timeouts and transient errors")
+    parser.add_argument("--qr-format", choices=QR_FORMATS, default="png",
+                        help="write QR codes as 1-bit PNG or as SVG")
+    parser.add_argument("--qr-workers", type=int, default=QR_WORKERS,
+                        help="background QR rendering workers, 0 renders inline")
+    parser.add_argument("--qr-processes", action="store_true",
+                        help="render QR codes in worker processes instead of threads")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--pipeline-depth", type=int, default=PIPELINE_DEPTH,
+                        help="bottles the output worker may fall behind by, 0 outputs inline")
+    parser.add_argument("--uid-cache-size", type=int, default=UID_CACHE_SIZE,
+                        help="recently handled UIDs to remember, 0 disables the cache")
+    parser.add_argument("--uid-cache-ttl", type=float, default=UID_CACHE_TTL,
+                        help="seconds a handled UID is remembered")
+    parser.add_argument("--verify-tag", action="store_true",
+                        help="read the bottle ID from the tag even if its UID is known")
+    station_profiler.add_arguments(parser)
+    args = parser.parse_args()
+
     DB_PATH = "/home/maxsim/maxsim-NFC-raspi/data/flaschen_database.db"
-    machine = StateMachine(DB_PATH)
-    machine.run()
\ No newline at end of file
+    machine = StateMachine(DB_PATH, daemon=args.daemon, qr_workers=args.qr_workers,
+                           qr_format=args.qr_format, qr_processes=args.qr_processes,
+                           pipeline_depth=args.pipeline_depth, verify_tag=args.verify_tag,
+                           uid_cache_size=args.uid_cache_size, uid_cache_ttl=args.uid_cache_ttl)
+    if args.metrics_port:
+        serve_metrics(machine.metrics, args.metrics_port)
+    signal.signal(signal.SIGTERM, lambda signum, frame: machine.stop())
+    if args.profile:
+        profiler = station_profiler.ProfileSession.from_args(machine, station=2, args=args)
+        profiler.start()
+        try:
+            machine.run()
+        finally:
+            print(f"Profile written to {profiler.dump()}")
+    else:
+        machine.run()
@@ -0,0 +1,109 @@
+# Connection profile and schema migrations for the station database
+import logging
+import sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+# Applied to every connection the stations open, in this order
+CONNECTION_PROFILE = {
+    # First, so that switching to WAL waits for a lock held by the other station instead of failing
+    "busy_timeout": 5000,
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 64 * 1024 * 1024,
+    "cache_size": -16 * 1024,   # negative: size in KiB
+    "temp_store": "MEMORY",
+}
+
+# Schema changes in order; PRAGMA user_version records how many have been applied.
+# An entry is one statement or a list of statements applied in the same transaction.
+MIGRATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS Flaschen_Reservierung (
+        Flaschen_ID INTEGER PRIMARY KEY REFERENCES Flasche (Flaschen_ID),
+        State TEXT NOT NULL,
+        Owner TEXT NOT NULL,
+        Reserved_At INTEGER NOT NULL,
+        Expires_At INTEGER NOT NULL
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_flasche_tagged_date ON Flasche (Tagged_Date)",
+    "CREATE INDEX IF NOT EXISTS idx_rezept_granulat_rezept_id ON Rezept_besteht_aus_Granulat (Rezept_ID)",
+    # Change counter for recipe contents, lets caches skip reloads on unrelated commits
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS Rezept_Version (
+            ID INTEGER PRIMARY KEY CHECK (ID = 1),
+            Version INTEGER NOT NULL
+        )
+        ''',
+        "INSERT OR IGNORE INTO Rezept_Version (ID, Version) VALUES (1, 0)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_rezept_granulat_insert AFTER INSERT ON Rezept_besteht_aus_Granulat
+        BEGIN UPDATE Rezept_Version SET Version = Version + 1 WHERE ID = 1; END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_rezept_granulat_update AFTER UPDATE ON Rezept_besteht_aus_Granulat
+        BEGIN UPDATE Rezept_Version SET Version = Version + 1 WHERE ID = 1; END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_rezept_granulat_delete AFTER DELETE ON Rezept_besteht_aus_Granulat
+        BEGIN UPDATE Rezept_Version SET Version = Version + 1 WHERE ID = 1; END
+        ''',
+    ],
+    # UID of the tag a bottle was tagged with, so Station 2 can find the bottle without reading the tag
+    [
+        "ALTER TABLE Flasche ADD COLUMN Tag_UID BLOB",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_flasche_tag_uid ON Flasche (Tag_UID)",
+    ],
+]
+
+
+def apply_connection_profile(conn, profile=None):
+    for pragma, value in (profile or CONNECTION_PROFILE).items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+
+def migrate(conn):
+    """
+    Apply the migrations the database has not seen yet. Returns the number applied.
+    """
+    applied = 0
+    while True:
+        # Re-read the version inside the write lock, another station may be migrating too
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                return applied
+            statements = MIGRATIONS[version]
+            for statement in [statements] if isinstance(statements, str) else statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied += 1
+        logger.info("Applied database migration %d", version + 1)
+
+
+def connect(db_path, migrations=True, profile=None, trace=None):
+    """
+    Open the station database with the tuned connection profile and, by default,
+    bring its schema up to date. trace is passed to set_trace_callback() once the
+    connection is set up and is called with every statement run on it afterwards.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        apply_connection_profile(conn, profile)
+        if migrations:
+            migrate(conn)
+    except BaseException:
+        conn.close()
+        raise
+    if trace is not None:
+        conn.set_trace_callback(trace)
+    return conn
@@ -0,0 +1,54 @@
+# Error classes and retry backoff shared by the station state machines
+
+
+class RecoverableError(Exception):
+    """
+    A transient problem (failed authentication, unreadable tag, locked database).
+    In daemon mode the station retries after a backoff delay.
+    """
+
+
+class IdleTimeout(RecoverableError):
+    """
+    No bottle arrived while waiting for a card.
+    """
+
+
+class FatalError(Exception):
+    """
+    The reader hardware is gone; the station cannot continue.
+    """
+
+
+def classify_error(error):
+    """
+    Map an exception raised inside a state to RecoverableError or FatalError.
+    Anything that is not explicitly fatal is treated as recoverable; a lost reader
+    is detected by probing it after repeated failures.
+    """
+    if isinstance(error, (RecoverableError, FatalError)):
+        return error
+    return RecoverableError(str(error))
+
+
+class Backoff:
+    """
+    Exponential backoff: initial, initial * factor, ... capped at maximum seconds.
+    """
+
+    def __init__(self, initial=0.1, maximum=5.0, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+        # Sum of all delays handed out, i.e. seconds the station spent backing off
+        self.total_delay = 0.0
+
+    def next_delay(self):
+        delay = min(self.initial * self.factor ** self.attempts, self.maximum)
+        self.attempts += 1
+        self.total_delay += delay
+        return delay
+
+    def reset(self):
+        self.attempts = 0
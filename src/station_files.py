@@ -0,0 +1,20 @@
+# Location of the station scripts, for the tools that run or measure them
+import importlib.util
+import os
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATION_FILES = {
+    1: os.path.join(SRC_DIR, "station_1_state-machine.py"),
+    2: os.path.join(SRC_DIR, "station_2_state-machine.py"),
+}
+
+
+def load_station(station):
+    """
+    Import a station script; the file names contain dashes, so they cannot be imported by name.
+    """
+    spec = importlib.util.spec_from_file_location(f"station_{station}_state_machine", STATION_FILES[station])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
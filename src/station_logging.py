@@ -0,0 +1,138 @@
+# Queued logging shared by the station state machines
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+
+LOG_DIR_ENV_VAR = "STATION_LOG_DIR"
+DEFAULT_LOG_DIRECTORY = "/home/maxsim/maxsim-NFC-raspi/logging"
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+# Size based rotation by default; set STATION_LOG_ROTATE_WHEN (e.g. "midnight") to rotate by time instead
+MAX_BYTES_ENV_VAR = "STATION_LOG_MAX_BYTES"
+BACKUP_COUNT_ENV_VAR = "STATION_LOG_BACKUPS"
+ROTATE_WHEN_ENV_VAR = "STATION_LOG_ROTATE_WHEN"
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+
+_queue = queue.SimpleQueue()
+_listener = None
+_console_handlers = []
+_event_loggers = set()
+
+
+def log_directory():
+    directory = os.environ.get(LOG_DIR_ENV_VAR, DEFAULT_LOG_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _rotating_file_handler(path):
+    backup_count = int(os.environ.get(BACKUP_COUNT_ENV_VAR, DEFAULT_BACKUP_COUNT))
+    when = os.environ.get(ROTATE_WHEN_ENV_VAR)
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count)
+    max_bytes = int(os.environ.get(MAX_BYTES_ENV_VAR, DEFAULT_MAX_BYTES))
+    return logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+
+
+def _not_an_event(record):
+    return record.name not in _event_loggers
+
+
+def _start_listener():
+    """
+    Move the root logger's handlers behind the queue, so console output is written
+    by the listener thread as well.
+    """
+    global _listener
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if not isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+            _console_handlers.append(handler)
+    if not _console_handlers:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        _console_handlers.append(console_handler)
+    for handler in _console_handlers:
+        handler.addFilter(_not_an_event)
+    if not any(isinstance(handler, logging.handlers.QueueHandler) for handler in root.handlers):
+        root.addHandler(logging.handlers.QueueHandler(_queue))
+
+    _listener = logging.handlers.QueueListener(_queue, *_console_handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+
+
+def station_logger(name, file_name, level=logging.DEBUG):
+    """
+    Return the logger of one station and the path of its log file.
+
+    Records are put on a queue and written by a single listener thread, to the
+    rotating log file and to the console; the state machine never waits for disk
+    or terminal I/O.
+    """
+    if _listener is None:
+        _start_listener()
+    log_file_path = os.path.join(log_directory(), file_name)
+
+    file_handler = _rotating_file_handler(log_file_path)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    file_handler.addFilter(logging.Filter(name))
+    _listener.handlers += (file_handler,)
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    # The logger's own queue handler feeds both its file and the console
+    logger.propagate = False
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(_queue))
+    return logger, log_file_path
+
+
+def event_logger(name, file_name):
+    """
+    Logger whose messages are written verbatim, one per line, to file_name in the log
+    directory and nowhere else. The file is append-only and never rotated.
+    """
+    if _listener is None:
+        _start_listener()
+    if name in _event_loggers:
+        # Machines of several lanes share their station's event file
+        return logging.getLogger(name)
+    file_handler = logging.FileHandler(os.path.join(log_directory(), file_name))
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    file_handler.addFilter(logging.Filter(name))
+    _event_loggers.add(name)
+    _listener.handlers += (file_handler,)
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(_queue))
+    return logger
+
+
+def set_console_level(level):
+    for handler in _console_handlers:
+        handler.setLevel(level)
+
+
+def stop():
+    """
+    Write out everything still queued and close the log files.
+    """
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.flush()
+        if handler not in _console_handlers:
+            handler.close()
+    _listener = None
@@ -0,0 +1,211 @@
+# Per-state latency, PN532 and SQLite counters of a station, in Prometheus text format
+from collections import Counter, defaultdict
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the state duration histogram
+STATE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATES = ('State0', 'State1', 'State2', 'State3', 'State4', 'State5')
+# PN532 methods and properties that each send a command frame to the chip
+PN532_COMMANDS = frozenset({
+    "firmware_version",
+    "SAM_configuration",
+    "read_passive_target",
+    "listen_for_passive_target",
+    "get_passive_target",
+    "power_down",
+    "call_function",
+    "mifare_classic_authenticate_block",
+    "mifare_classic_read_block",
+    "mifare_classic_write_block",
+    "ntag2xx_read_block",
+    "ntag2xx_write_block",
+})
+
+
+class TimedPN532:
+    """
+    Wraps a PN532 object and records count and time of every command sent through it.
+    """
+
+    def __init__(self, pn532, record):
+        self._pn532 = pn532
+        self._record = record
+
+    def __getattr__(self, name):
+        if name not in PN532_COMMANDS:
+            return getattr(self._pn532, name)
+        started = time.perf_counter()
+        value = getattr(self._pn532, name)
+        if not callable(value):
+            # A property such as firmware_version talks to the chip on access
+            self._record(name, time.perf_counter() - started)
+            return value
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                self._record(name, time.perf_counter() - started)
+        return timed
+
+
+class StationMetrics:
+    """
+    StateMachine listener keeping the station's metrics.
+
+    Records how long every state run took, which state the machine is in, and
+    which errors were passed to fail(). Once State0 has run it also wraps the
+    reader's PN532 in TimedPN532. The station passes record_query as trace hook
+    to every SQLite connection it opens, including those of its background
+    workers. render() returns everything in the Prometheus text exposition format.
+    """
+
+    def __init__(self, machine, station, lane=None):
+        self.machine = machine
+        self.station = station
+        self.lane = lane
+        self._lock = threading.Lock()
+        self.current_state = machine.current_state
+        # state -> runs per histogram bucket, made cumulative by render()
+        self.state_buckets = defaultdict(lambda: [0] * len(STATE_BUCKETS))
+        self.state_seconds = Counter()
+        self.state_runs = Counter()
+        self.errors = Counter()
+        self.pn532_commands = Counter()
+        self.pn532_seconds = Counter()
+        self.sql_queries = Counter()
+
+    def __call__(self, state, next_state, elapsed):
+        with self._lock:
+            buckets = self.state_buckets[state]
+            for index, bound in enumerate(STATE_BUCKETS):
+                if elapsed <= bound:
+                    buckets[index] += 1
+                    break
+            self.state_seconds[state] += elapsed
+            self.state_runs[state] += 1
+            self.current_state = next_state
+            error = self.machine.last_error
+            if error is not None:
+                self.errors[(state, type(error).__name__)] += 1
+        if state == 'State0':
+            self.attach()
+
+    def attach(self):
+        reader = self.machine.nfc_reader
+        if reader is not None and not isinstance(reader._pn532, TimedPN532):
+            reader._pn532 = TimedPN532(reader._pn532, self.record_command)
+
+    def record_command(self, command, elapsed):
+        with self._lock:
+            self.pn532_commands[command] += 1
+            self.pn532_seconds[command] += elapsed
+
+    def record_query(self, statement):
+        # Trace callback of every station connection, so it runs on the worker threads too
+        with self._lock:
+            self.sql_queries[statement.split(None, 1)[0].upper()] += 1
+
+    def _machine_values(self):
+        """
+        (name, type, value, help) of the backoff sleeps and of the station's background
+        workers, where it has them. Each worker's metrics() returns the same tuples,
+        with counters named *_total; their names get the worker's prefix here.
+        """
+        values = [("station_backoff_seconds_total", "counter", self.machine.backoff.total_delay,
+                   "Time spent sleeping between retries.")]
+        for attribute, prefix in (("tagging_writer", "station_write_behind_"), ("qr_renderer", "station_qr_"),
+                                  ("pipeline", "station_pipeline_"), ("recent_uids", "station_uid_cache_")):
+            worker = getattr(self.machine, attribute, None)
+            if worker is not None:
+                values.extend((prefix + name, kind, value, help_text)
+                              for name, kind, value, help_text in worker.metrics())
+        pool = getattr(self.machine, "id_pool", None)
+        if pool is not None:
+            values.append(("station_id_pool_size", "gauge", len(pool), "Reserved bottle IDs in the pool."))
+        return values
+
+    def render(self):
+        station = f'station="{self.station}"' if self.lane is None else f'station="{self.station}",lane="{self.lane}"'
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            family("station_state_duration_seconds", "histogram", "Time spent in one run of a state.")
+            for state in sorted(self.state_runs):
+                cumulative = 0
+                for bound, count in zip(STATE_BUCKETS, self.state_buckets[state]):
+                    cumulative += count
+                    lines.append(f'station_state_duration_seconds_bucket{{{station},state="{state}",le="{bound}"}} {cumulative}')
+                lines.append(f'station_state_duration_seconds_bucket{{{station},state="{state}",le="+Inf"}} {self.state_runs[state]}')
+                lines.append(f'station_state_duration_seconds_sum{{{station},state="{state}"}} {self.state_seconds[state]:.6f}')
+                lines.append(f'station_state_duration_seconds_count{{{station},state="{state}"}} {self.state_runs[state]}')
+
+            family("station_current_state", "gauge", "1 for the state the machine is in, 0 for the others.")
+            for state in STATES:
+                lines.append(f'station_current_state{{{station},state="{state}"}} {int(state == self.current_state)}')
+
+            family("station_errors_total", "counter", "Errors passed to fail(), by state and error type.")
+            for (state, error), count in sorted(self.errors.items()):
+                lines.append(f'station_errors_total{{{station},state="{state}",error="{error}"}} {count}')
+
+            family("station_pn532_commands_total", "counter", "Commands sent to the PN532.")
+            for command, count in sorted(self.pn532_commands.items()):
+                lines.append(f'station_pn532_commands_total{{{station},command="{command}"}} {count}')
+            family("station_pn532_command_seconds_total", "counter", "Time spent waiting for PN532 commands.")
+            for command, seconds in sorted(self.pn532_seconds.items()):
+                lines.append(f'station_pn532_command_seconds_total{{{station},command="{command}"}} {seconds:.6f}')
+
+            family("station_sqlite_queries_total", "counter", "Statements run on the station's SQLite connections.")
+            for statement, count in sorted(self.sql_queries.items()):
+                lines.append(f'station_sqlite_queries_total{{{station},statement="{statement}"}} {count}')
+
+        for name, kind, value, help_text in self._machine_values():
+            family(name, kind, help_text)
+            lines.append(f"{name}{{{station}}} {value:.6f}" if isinstance(value, float) else f"{name}{{{station}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _handler_class():
+    # http.server pulls in email and http.client; only import it when metrics are served
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = self.server.metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics request: " + format, *args)
+
+    return MetricsHandler
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+    Serve metrics.render() at http://host:port/metrics from a daemon thread. Returns the server.
+    """
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer((host, port), _handler_class())
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="station-metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, server.server_port)
+    return server
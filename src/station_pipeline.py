@@ -0,0 +1,135 @@
+# Worker stage of a station: per-bottle database, QR and log work off the tag I/O thread
+from collections import Counter
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEPTH = 8
+_STOP = object()
+
+
+class WorkerStage:
+    """
+    Runs the jobs a station's hardware stage hands over, in order, on one thread.
+
+    The hardware stage only does tag I/O: once a bottle's tag has been handled it
+    submits the rest of the bottle's work and goes straight back to waiting for the
+    next one, so a cycle takes as long as the slower of the two stages instead of
+    both together. At most `depth` jobs wait in the queue; submit() blocks when it
+    is full, which holds the conveyor back when the worker falls behind instead of
+    piling up work in memory.
+
+    on_start and on_stop run on the worker thread, e.g. to open and close a
+    database connection of its own. start() waits for on_start and raises what it
+    raised, so a stage that could not start never accepts jobs. A job that raises
+    is counted and passed to on_error(key, error), e.g. to log it to the station's
+    own logger and event file, or logged here without one; the jobs after it still run.
+    """
+
+    def __init__(self, name, depth=DEFAULT_DEPTH, on_start=None, on_stop=None, on_error=None):
+        self.name = name
+        self.depth = depth
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.on_error = on_error
+        self._queue = queue.Queue(maxsize=depth)
+        # Keys of the jobs submitted but not finished yet
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._started = threading.Event()
+        self._start_error = None
+        self.completed = 0
+        self.failed = 0
+        self.blocked_seconds = 0.0
+
+    def start(self):
+        self._started.clear()
+        self._start_error = None
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        if self._start_error is not None:
+            self._thread.join()
+            self._thread = None
+            raise self._start_error
+
+    def metrics(self):
+        """
+        (name, type, value, help) of every metric, see StationMetrics.
+        """
+        return [
+            ("queue_depth", "gauge", self._queue.qsize(), "Jobs waiting for the worker stage."),
+            ("completed_total", "counter", self.completed, "Jobs the worker stage finished."),
+            ("failed_total", "counter", self.failed, "Jobs that raised on the worker stage."),
+            ("blocked_seconds_total", "counter", self.blocked_seconds, "Time spent waiting for a full worker queue."),
+        ]
+
+    def is_pending(self, key):
+        return self._pending[key] > 0
+
+    def submit(self, key, function, *args):
+        """
+        Queue function(*args) and return; blocks while `depth` jobs are waiting.
+        """
+        with self._lock:
+            self._pending[key] += 1
+        started = time.perf_counter()
+        self._queue.put((key, function, args))
+        waited = time.perf_counter() - started
+        if waited > 0.001:
+            self.blocked_seconds += waited
+            logger.warning("%s is %d jobs behind, waited %.3f s", self.name, self.depth, waited)
+
+    def close(self):
+        """
+        Run everything still queued and stop the thread.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        try:
+            if self.on_start is not None:
+                self.on_start()
+        except BaseException as e:
+            self._start_error = e
+            return
+        finally:
+            self._started.set()
+        try:
+            while True:
+                job = self._queue.get()
+                if job is _STOP:
+                    break
+                key, function, args = job
+                try:
+                    function(*args)
+                    self.completed += 1
+                except Exception as e:
+                    self.failed += 1
+                    self._report(key, e)
+                finally:
+                    with self._lock:
+                        self._pending[key] -= 1
+                        if not self._pending[key]:
+                            del self._pending[key]
+        finally:
+            if self.on_stop is not None:
+                self.on_stop()
+
+    def _report(self, key, error):
+        if self.on_error is None:
+            logger.error("%s: job for %s failed", self.name, key, exc_info=error)
+            return
+        try:
+            self.on_error(key, error)
+        except Exception:
+            logger.exception("%s: error handler failed for %s", self.name, key)
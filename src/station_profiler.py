@@ -0,0 +1,166 @@
+# Profiling mode for the station runners: pstats and collapsed stacks per state
+from collections import Counter
+import io
+import logging
+import os
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("both", "cprofile", "sampling")
+DEFAULT_INTERVAL = 0.005
+DEFAULT_PROFILE_DIR = "profiles"
+
+
+def add_arguments(parser):
+    """
+    Add the --profile options to a station's argument parser.
+    """
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the state machine and write the results to --profile-dir")
+    parser.add_argument("--profile-mode", choices=PROFILE_MODES, default="both",
+                        help="cProfile (pstats), a sampling profiler (collapsed stacks) or both")
+    parser.add_argument("--profile-bottles", type=int, help="stop after this many bottles")
+    parser.add_argument("--profile-seconds", type=float, help="stop after this many seconds")
+    parser.add_argument("--profile-interval", type=float, default=DEFAULT_INTERVAL,
+                        help="seconds between two samples of the sampling profiler")
+    parser.add_argument("--profile-dir", default=DEFAULT_PROFILE_DIR)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class ProfileSession:
+    """
+    Profiles a StateMachine state by state.
+
+    Each state's run() is wrapped so that cProfile collects into one profile per
+    state class, and the sampling thread prefixes the stacks it takes with the name
+    of the state running at that moment. The session stops the machine after
+    `bottles` completed bottles (runs of State4) or `seconds` seconds, whichever
+    comes first; dump() then writes <state>.pstats, all.pstats, stacks.collapsed
+    (one "frame;frame;... count" line per stack, as flamegraph.pl expects) and a
+    summary.txt with the top functions per state.
+    """
+
+    def __init__(self, machine, output_dir, mode="both", bottles=None, seconds=None, interval=DEFAULT_INTERVAL):
+        self.machine = machine
+        self.output_dir = output_dir
+        self.use_cprofile = mode in ("both", "cprofile")
+        self.use_sampling = mode in ("both", "sampling")
+        self.bottles = bottles
+        self.seconds = seconds
+        self.interval = interval
+        self.profiles = {}
+        self.stacks = Counter()
+        self.completed = 0
+        self.active_state = None
+        self._run_frame = None
+        self._thread_id = None
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+        self._started = None
+
+    @classmethod
+    def from_args(cls, machine, station, args):
+        output_dir = os.path.join(args.profile_dir, f"station{station}-{time.strftime('%Y%m%d-%H%M%S')}")
+        return cls(machine, output_dir, mode=args.profile_mode, bottles=args.profile_bottles,
+                   seconds=args.profile_seconds, interval=args.profile_interval)
+
+    def start(self):
+        for name, state in self.machine.states.items():
+            state.run = self._wrap(name, state.run)
+        self.machine.listeners.append(self)
+        self._thread_id = threading.get_ident()
+        self._started = time.monotonic()
+        if self.use_sampling:
+            self._sampler = threading.Thread(target=self._sample, name="station-profiler", daemon=True)
+            self._sampler.start()
+
+    def _wrap(self, name, run):
+        import cProfile
+
+        profile = self.profiles.setdefault(name, cProfile.Profile()) if self.use_cprofile else None
+
+        def profiled_run():
+            self._run_frame = sys._getframe()
+            self.active_state = name
+            if profile is not None:
+                profile.enable()
+            try:
+                return run()
+            finally:
+                if profile is not None:
+                    profile.disable()
+                self.active_state = None
+        return profiled_run
+
+    def __call__(self, state, next_state, elapsed):
+        if state == 'State4':
+            self.completed += 1
+        if self.bottles is not None and self.completed >= self.bottles:
+            self.machine.stop()
+        if self.seconds is not None and time.monotonic() - self._started >= self.seconds:
+            self.machine.stop()
+
+    def _sample(self):
+        while not self._stop_sampling.wait(self.interval):
+            state = self.active_state
+            frame = sys._current_frames().get(self._thread_id)
+            if state is None or frame is None:
+                continue
+            names = []
+            # Only the frames below the state's run(), not the runner above it
+            while frame is not None and frame is not self._run_frame:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            names.append(state)
+            self.stacks[";".join(reversed(names))] += 1
+
+    def dump(self):
+        """
+        Stop sampling and write the results. Returns the output directory.
+        """
+        import pstats
+
+        self._stop_sampling.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        summary = io.StringIO()
+        summary.write(f"{self.completed} bottles in {time.monotonic() - self._started:.1f} s\n")
+        combined = None
+        for name, profile in sorted(self.profiles.items()):
+            if not profile.getstats():
+                continue
+            profile.dump_stats(os.path.join(self.output_dir, f"{name}.pstats"))
+            if combined is None:
+                combined = pstats.Stats(profile)
+            else:
+                combined.add(profile)
+            summary.write(f"\n=== {name} ===\n")
+            pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(15)
+        if combined is not None:
+            combined.dump_stats(os.path.join(self.output_dir, "all.pstats"))
+
+        if self.use_sampling:
+            with open(os.path.join(self.output_dir, "stacks.collapsed"), "w") as collapsed:
+                for stack, count in self.stacks.most_common():
+                    collapsed.write(f"{stack} {count}\n")
+            summary.write(f"\n{sum(self.stacks.values())} samples every {self.interval * 1000:.1f} ms\n")
+            samples_per_state = Counter()
+            for stack, count in self.stacks.items():
+                samples_per_state[stack.split(";", 1)[0]] += count
+            for state, count in sorted(samples_per_state.items()):
+                summary.write(f"  {state}: {count}\n")
+
+        with open(os.path.join(self.output_dir, "summary.txt"), "w") as summary_file:
+            summary_file.write(summary.getvalue())
+        logger.info("Profile written to %s", self.output_dir)
+        return self.output_dir
@@ -0,0 +1,64 @@
+# Versioned on-tag record written by Station 1 into block 2
+import binascii
+import hashlib
+import struct
+from collections import namedtuple
+
+
+TAG_RECORD_VERSION = 1
+RECORD_SIZE = 16
+DIGEST_SIZE = 3
+
+# version, Flaschen_ID, Rezept_ID, tag timestamp, recipe digest; followed by a CRC-16 of these 14 bytes
+_BODY = struct.Struct(">BIHI3s")
+_CRC = struct.Struct(">H")
+
+TagRecord = namedtuple("TagRecord", ["bottle_id", "recipe_id", "tagged_at", "recipe_digest"])
+
+
+def recipe_digest(recipe):
+    """
+    Short hash of a recipe's (Granulat_ID, Menge) pairs, used to detect recipes that changed after tagging.
+    """
+    canonical = ";".join(f"{granule_id}:{float(quantity)!r}" for granule_id, quantity in recipe)
+    return hashlib.blake2s(canonical.encode(), digest_size=DIGEST_SIZE).digest()
+
+
+def encode(record):
+    """
+    Pack a TagRecord into one 16-byte MIFARE block.
+    """
+    body = _BODY.pack(TAG_RECORD_VERSION, record.bottle_id, record.recipe_id,
+                      record.tagged_at, record.recipe_digest)
+    return body + _CRC.pack(binascii.crc_hqx(body, 0xFFFF))
+
+
+def decode(data):
+    """
+    Unpack a block written by encode(). Returns None for the legacy layout (the
+    bottle ID as a 16-byte big-endian integer, whose first byte is always zero)
+    and raises ValueError for a record that fails its CRC.
+    """
+    data = bytes(data)
+    if len(data) != RECORD_SIZE:
+        raise ValueError(f"Tag record must be {RECORD_SIZE} bytes, got {len(data)}")
+    if data[0] == 0:
+        return None
+    if data[0] != TAG_RECORD_VERSION:
+        raise ValueError(f"Unknown tag record version {data[0]}")
+
+    body, (crc,) = data[:_BODY.size], _CRC.unpack(data[_BODY.size:])
+    if binascii.crc_hqx(body, 0xFFFF) != crc:
+        raise ValueError("Tag record CRC mismatch")
+    _, bottle_id, recipe_id, tagged_at, digest = _BODY.unpack(body)
+    return TagRecord(bottle_id, recipe_id, tagged_at, digest)
+
+
+def bottle_id_from_block(data):
+    """
+    Bottle ID stored in a block, for both the versioned record and the legacy layout.
+    """
+    record = decode(data)
+    if record is None:
+        return int.from_bytes(data, byteorder='big')
+    return record.bottle_id
@@ -0,0 +1,73 @@
+# Recently handled tag UIDs, so a bottle that lingers or comes back is recognised without tag or database I/O
+from collections import OrderedDict
+import threading
+import time
+
+
+DEFAULT_SIZE = 256
+DEFAULT_TTL = 30.0
+
+
+class RecentUIDs:
+    """
+    LRU cache of the last `size` tag UIDs a station handled and their outcome.
+
+    An entry expires `ttl` seconds after it was stored; a lookup does not extend
+    it, so a tag that was rewritten elsewhere (e.g. reset with
+    reset_ID_on_RFID_chip.py) is handled normally again after at most ttl seconds.
+    size 0 or ttl 0 disables the cache.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self._clock = clock
+        # uid -> (stored_at, outcome), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def metrics(self):
+        """
+        (name, type, value, help) of every metric, see StationMetrics.
+        """
+        return [
+            ("size", "gauge", len(self._entries), "UIDs remembered."),
+            ("hits_total", "counter", self.hits, "Lookups of a recently handled UID."),
+            ("misses_total", "counter", self.misses, "Lookups of a UID that was not handled recently."),
+        ]
+
+    def get(self, uid):
+        """
+        Outcome stored for uid, or None if it was not handled within the last ttl seconds.
+        """
+        uid = bytes(uid)
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is not None and self._clock() - entry[0] >= self.ttl:
+                del self._entries[uid]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(uid)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, uid, outcome):
+        if not self.size or not self.ttl:
+            return
+        uid = bytes(uid)
+        with self._lock:
+            self._entries[uid] = (self._clock(), outcome)
+            self._entries.move_to_end(uid)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, uid):
+        with self._lock:
+            self._entries.pop(bytes(uid), None)
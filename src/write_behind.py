@@ -0,0 +1,239 @@
+# Write-behind queue that commits Station 1 tagging results to SQLite in batches
+from collections import OrderedDict
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from id_reservation import IDReservations
+import station_db
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_FLUSH_INTERVAL = 2.0
+
+
+def _journal_line(bottle_id, tagged_date, tag_uid):
+    return f"{bottle_id},{tagged_date},{tag_uid.hex() if tag_uid else ''}\n"
+
+
+def _cancel_line(bottle_id):
+    # Takes back the entry of a bottle whose tag write failed
+    return f"-{bottle_id}\n"
+
+
+class TaggingWriteBehind:
+    """
+    Groups tagging results and commits them in one transaction per batch.
+
+    The journal, an append-only file, is the only per-bottle record on disk.
+    journal_written() appends the result before the bottle ID is written to the
+    tag; from then on the ID counts as written, so a crash replays it and an
+    expired reservation of it is reclaimed as tagged (see journaled()). submit()
+    then only queues the result, and cancel() takes it back if the tag write
+    failed. A background thread with its own connection commits once batch_size
+    results are queued or the oldest one has waited flush_interval seconds, then
+    drops the committed entries from the journal. Entries left in the journal by a
+    crash are replayed by start(). With fsync enabled every journal append is
+    synced to disk, which is a single small sequential write instead of a full
+    SQLite commit. Failed commits are logged to logger, e.g. the station's own.
+    """
+
+    def __init__(self, db_path, journal_path, owner=None, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, fsync=True, trace=None, logger=None):
+        self.db_path = db_path
+        self.journal_path = journal_path
+        self.owner = owner
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.trace = trace
+        self.logger = logger or logging.getLogger(__name__)
+        # bottle_id -> (tagged_date, tag_uid) journaled before the tag write, not submitted yet
+        self._written = OrderedDict()
+        # bottle_id -> (tagged_date, tag_uid) for every result not committed yet
+        self._pending = OrderedDict()
+        self._oldest = None
+        self._condition = threading.Condition()
+        self._journal = None
+        self._closed = False
+        self._thread = None
+        self.committed = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.replayed = 0
+
+    def start(self):
+        self._replay_journal()
+        self._journal = open(self.journal_path, "a")
+        self._thread = threading.Thread(target=self._run, name="tagging-write-behind", daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def metrics(self):
+        """
+        (name, type, value, help) of every metric, see StationMetrics.
+        """
+        return [
+            ("queue_depth", "gauge", self.queue_depth, "Tagging results waiting to be committed."),
+            ("committed_total", "counter", self.committed, "Tagging results committed to the database."),
+            ("batches_total", "counter", self.batches, "Batches committed to the database."),
+            ("last_batch_size", "gauge", self.last_batch_size, "Tagging results in the last committed batch."),
+            ("replayed_total", "counter", self.replayed, "Tagging results replayed from the journal at start-up."),
+        ]
+
+    def is_pending(self, bottle_id):
+        return bottle_id in self._pending or bottle_id in self._written
+
+    def journaled(self):
+        """
+        IDs of the bottles journaled as written whose result is not committed yet.
+        """
+        with self._condition:
+            return set(self._written) | set(self._pending)
+
+    def journal_written(self, bottle_id, tagged_date, tag_uid=None):
+        """
+        Journal a result before the bottle ID is written to the tag.
+        """
+        with self._condition:
+            self._append(_journal_line(bottle_id, tagged_date, tag_uid))
+            self._written[bottle_id] = (tagged_date, tag_uid)
+
+    def cancel(self, bottle_id):
+        """
+        Drop a result journaled by journal_written() whose tag write failed.
+        """
+        with self._condition:
+            if self._written.pop(bottle_id, None) is not None:
+                self._append(_cancel_line(bottle_id))
+
+    def submit(self, bottle_id, tagged_date, tag_uid=None):
+        with self._condition:
+            if self._written.pop(bottle_id, None) is None:
+                # Not journaled before the write, e.g. a tag written by an earlier run
+                self._append(_journal_line(bottle_id, tagged_date, tag_uid))
+            self._pending[bottle_id] = (tagged_date, tag_uid)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def close(self):
+        """
+        Commit everything still queued and stop the background thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self._journal is not None:
+            self._journal.close()
+
+    def _append(self, line):
+        self._journal.write(line)
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _queued(self):
+        return [(bottle_id, tagged_date, tag_uid) for bottle_id, (tagged_date, tag_uid) in self._pending.items()]
+
+    def _read_journal(self):
+        results = OrderedDict()
+        if not os.path.exists(self.journal_path):
+            return results
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    if line.startswith("-"):
+                        results.pop(int(line[1:]), None)
+                        continue
+                    # Journals written before the UID was recorded have two fields
+                    bottle_id, tagged_date, *tag_uid = line.strip().split(",")
+                    results[int(bottle_id)] = (int(tagged_date), bytes.fromhex(tag_uid[0]) if tag_uid and tag_uid[0] else None)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    self.logger.warning("Skipping malformed journal entry: %r", line)
+        return results
+
+    def _replay_journal(self):
+        results = self._read_journal()
+        if not results:
+            return
+        conn = station_db.connect(self.db_path, migrations=False, trace=self.trace)
+        try:
+            IDReservations(conn, owner=self.owner).confirm_many(
+                [(bottle_id, tagged_date, tag_uid) for bottle_id, (tagged_date, tag_uid) in results.items()])
+        finally:
+            conn.close()
+        self.replayed = len(results)
+        self.logger.warning("Replayed %d tagging result(s) from %s", len(results), self.journal_path)
+        self._rewrite_journal([])
+
+    def _rewrite_journal(self, results):
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w") as journal:
+            journal.writelines(_journal_line(*result) for result in results)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp_path, self.journal_path)
+
+    def _run(self):
+        conn = station_db.connect(self.db_path, migrations=False, trace=self.trace)
+        reservations = IDReservations(conn, owner=self.owner)
+        try:
+            while True:
+                with self._condition:
+                    while not self._closed:
+                        if len(self._pending) >= self.batch_size:
+                            break
+                        if self._oldest is not None:
+                            remaining = self._oldest + self.flush_interval - time.monotonic()
+                            if remaining <= 0:
+                                break
+                            self._condition.wait(remaining)
+                        else:
+                            self._condition.wait()
+                    batch = self._queued()
+                    closed = self._closed
+                if batch:
+                    self._commit(reservations, batch)
+                if closed:
+                    break
+        finally:
+            conn.close()
+
+    def _commit(self, reservations, batch):
+        try:
+            reservations.confirm_many(batch)
+        except sqlite3.Error as e:
+            # Results stay queued and journaled; the next round retries them
+            self.logger.error("Failed to commit %d tagging result(s): %s", len(batch), e)
+            with self._condition:
+                self._oldest = time.monotonic()
+                if self._closed:
+                    return
+            time.sleep(self.flush_interval)
+            return
+
+        with self._condition:
+            for bottle_id, _, _ in batch:
+                self._pending.pop(bottle_id, None)
+            self._oldest = time.monotonic() if self._pending else None
+            # Keep only the results that arrived while the batch was committed
+            self._journal.close()
+            self._rewrite_journal([(bottle_id, tagged_date, tag_uid)
+                                   for bottle_id, (tagged_date, tag_uid) in self._written.items()] + self._queued())
+            self._journal = open(self.journal_path, "a")
+        self.committed += len(batch)
+        self.batches += 1
+        self.last_batch_size = len(batch)
+        self.logger.debug("Committed %d tagging result(s)", len(batch))